@@ -0,0 +1,102 @@
+"""Compare the old and new serialization of chat documents."""
+
+import sys
+import timeit
+from dataclasses import asdict, dataclass, field, is_dataclass
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "src"))
+
+from mongo.chat import Chat
+
+HISTORY_LEN = 1000
+NUM_RUNS = 1000
+
+
+@dataclass
+class OldMessage:
+    """Message of chat history before the field codecs."""
+
+    message_id: int
+    channel_id: int
+    num_tokens: int | None = None
+    role: str | None = None
+    text: str | None = None
+    attachments: list[dict] = field(default_factory=list)
+
+
+@dataclass
+class OldChat:
+    """Chat document before the field codecs."""
+
+    user_id: int = -1
+    history: list[OldMessage] = field(default_factory=list)
+    token: bytes | None = None
+
+    @staticmethod
+    def from_dict(source: dict) -> "OldChat":
+        """Create a chat the way get_chat and Document._from_dict used to."""
+        source = source | {
+            "history": [OldMessage(**message) for message in source["history"]]
+        }
+        valid_keys = set(OldChat.__annotations__.keys())
+        return OldChat(**{k: v for k, v in source.items() if k in valid_keys})
+
+    def to_dict(self) -> dict:
+        """Convert this chat the way Document.to_dict used to."""
+        result = {}
+        for key, value in self.__dict__.items():
+            if isinstance(value, list):
+                result[key] = [asdict(v) if is_dataclass(v) else v for v in value]
+            elif is_dataclass(value):
+                result[key] = asdict(value)
+            else:
+                result[key] = value
+
+        return result
+
+
+def main() -> None:
+    """Run the Main function."""
+    source = {
+        "_id": "0",
+        "user_id": 0,
+        "history": [
+            {
+                "message_id": i,
+                "channel_id": i // 2,
+                "num_tokens": 10,
+                "role": "model" if i % 2 else "user",
+                "text": "text",
+                "attachments": [],
+            }
+            for i in range(HISTORY_LEN)
+        ],
+        "token": b"token",
+    }
+    old_chat = OldChat.from_dict(source)
+    new_chat = Chat.from_dict(source)
+
+    assert old_chat.to_dict() == new_chat.to_dict()  # noqa: S101
+
+    cases = [
+        (
+            "from_dict",
+            lambda: OldChat.from_dict(source),
+            lambda: Chat.from_dict(source),
+        ),
+        ("to_dict", old_chat.to_dict, new_chat.to_dict),
+    ]
+
+    print(f"History length: {HISTORY_LEN}, runs: {NUM_RUNS}")  # noqa: T201
+    for name, old, new in cases:
+        old_time = timeit.timeit(old, number=NUM_RUNS) / NUM_RUNS
+        new_time = timeit.timeit(new, number=NUM_RUNS) / NUM_RUNS
+        print(  # noqa: T201
+            f"{name}: old {old_time * 1e6:.1f}us, new {new_time * 1e6:.1f}us, "
+            f"{old_time / new_time:.1f}x faster"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""Compare the old and new conversion of movie frames to text."""
+
+import math
+import sys
+import time
+from collections.abc import Callable
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "src"))
+
+from commands.movie import (
+    CHAR_CODES,
+    CHARS,
+    MOBILE_CHAR_CODES,
+    MOBILE_CHARS,
+    MOBILE_MOVIE_RESOLUTION,
+    MOBILE_MOVIE_RESOLUTION_16_9,
+    MOVIE_RESOLUTION,
+    MOVIE_RESOLUTION_16_9,
+    PIXEL_VALUE_RANGE,
+    Movie,
+    _indices_to_text,
+)
+from utils.constants import ASSETS_DIR
+
+
+def old_create_text(frame: np.ndarray, is_mobile: bool) -> str:  # noqa: FBT001
+    """Convert the frame the way Movie._create_text used to."""
+    grayscale_frame = np.dot(frame, (0.2989, 0.5870, 0.1140))
+    grayscale_frame: np.ndarray = np.floor(grayscale_frame).astype(int)
+
+    char_length = len(MOBILE_CHARS) if is_mobile else len(CHARS)
+    normalized_frame: np.ndarray = grayscale_frame * char_length / PIXEL_VALUE_RANGE
+    normalized_frame = np.floor(normalized_frame).astype(int)
+
+    text = ""
+    for vector in normalized_frame:
+        for brightness in vector:
+            text += (MOBILE_CHARS[brightness] if is_mobile else CHARS[brightness]) * 2
+        text += "\n"
+
+    return text.removesuffix("\n")
+
+
+def new_create_text(frame: np.ndarray, is_mobile: bool) -> str:  # noqa: FBT001
+    """Convert the frame the way the frames are rendered and stored now."""
+    return _indices_to_text(
+        Movie._get_indices(frame),  # noqa: SLF001
+        MOBILE_CHAR_CODES if is_mobile else CHAR_CODES,
+    )
+
+
+def read_frames(path: Path) -> dict[bool, list[np.ndarray]]:
+    """Read all frames of the movie, resized for mobile and desktop."""
+    movie = cv2.VideoCapture(str(path))
+    frames: dict[bool, list[np.ndarray]] = {True: [], False: []}
+
+    _, frame = movie.read()
+    if frame is None:
+        raise ValueError(f"Movie '{path.name}' has no frames")
+
+    height, width, _ = frame.shape
+    if math.isclose(width / height, 4 / 3):
+        resolutions = {True: MOBILE_MOVIE_RESOLUTION, False: MOVIE_RESOLUTION}
+    else:
+        resolutions = {True: MOBILE_MOVIE_RESOLUTION_16_9, False: MOVIE_RESOLUTION_16_9}
+
+    while frame is not None:
+        for is_mobile, resolution in resolutions.items():
+            frames[is_mobile].append(cv2.resize(frame, resolution))
+
+        _, frame = movie.read()
+
+    movie.release()
+    return frames
+
+
+def measure(
+    create_text: Callable[[np.ndarray, bool], str],
+    frames: list[np.ndarray],
+    is_mobile: bool,  # noqa: FBT001
+) -> tuple[float, list[str]]:
+    """Convert all frames, returning the mean time per frame and the texts."""
+    start = time.perf_counter()
+    texts = [create_text(frame, is_mobile) for frame in frames]
+    return (time.perf_counter() - start) / len(frames), texts
+
+
+def main() -> None:
+    """Run the Main function."""
+    paths = [Path(arg) for arg in sys.argv[1:]] or sorted(ASSETS_DIR.glob("*.mp4"))
+    if len(paths) == 0:
+        print(f"No movies given or found in {ASSETS_DIR}")  # noqa: T201
+        return
+
+    for path in paths:
+        for is_mobile, frames in read_frames(path).items():
+            old_time, old_texts = measure(old_create_text, frames, is_mobile)
+            new_time, new_texts = measure(new_create_text, frames, is_mobile)
+
+            assert old_texts == new_texts  # noqa: S101
+
+            print(  # noqa: T201
+                f"{path.name} ({'mobile' if is_mobile else 'desktop'}, "
+                f"{len(frames)} frames): old {old_time * 1e6:.1f}us/frame, "
+                f"new {new_time * 1e6:.1f}us/frame, "
+                f"{old_time / new_time:.1f}x faster"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -6,8 +6,12 @@ from discord import Interaction, app_commands
 from discord.ext.commands import Bot
 
 from commands import command
-from commands.translator import TranslatorChannelSelect, TranslatorLanguageSelectView
-from mongo.channel import get_channel, set_channel
+from commands.translator import (
+    TranslatorChannelSelect,
+    TranslatorLanguageSelectView,
+    translation_targets,
+)
+from mongo.channel import update_channels
 from utils import defer_response
 from utils.templates import error, success
 from utils.translator import DEFAULT_LANGUAGE, Localization
@@ -55,10 +59,10 @@ class Channel(app_commands.Group):
                 if this
                 else [channel.id for channel in channel_select.values]
             )
-            for channel in channels:
-                config = await get_channel(channel)
-                config.translate_to = list(language_view.selected)
-                await set_channel(config)
+            await update_channels(
+                channels, {"translate_to": list(language_view.selected)}
+            )
+            translation_targets.set_channels(channels, len(language_view.selected) > 0)
 
             await interaction.response.send_message(
                 success(await loc.format_value_or_translate("translator-set")),
@@ -109,10 +113,9 @@ class Channel(app_commands.Group):
                 )
                 return
 
-            for channel in channels:
-                config = await get_channel(channel)
-                config.locale = selected[0] if len(selected) != 0 else None
-                await set_channel(config)
+            await update_channels(
+                channels, {"locale": selected[0] if len(selected) != 0 else None}
+            )
 
             await interaction.response.send_message(
                 success(await loc.format_value_or_translate("language-set")),
@@ -1,33 +1,51 @@
 """Implements a commands relate to AI chat."""
 
+import asyncio
 import base64
 import contextlib
+import datetime as dt
+import hashlib
 import logging
 import os
-from collections.abc import Iterable
+import time
+from collections import OrderedDict, deque
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+from functools import cache, partial
 from http import HTTPStatus
 from pathlib import Path
 
 import aiofiles
+import aiohttp
 import discord
+import httpx
 from cryptography.fernet import Fernet
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from discord import Interaction, Member, Message, RawMessageUpdateEvent, app_commands
+from discord import (
+    Interaction,
+    Member,
+    Message,
+    RawMessageDeleteEvent,
+    RawMessageUpdateEvent,
+    app_commands,
+)
 from discord.ext.commands import Bot
 from google import genai
 from google.genai import types
-from google.genai.errors import ClientError
+from google.genai.errors import APIError, ClientError
 
 import mongo
 import mongo.chat
 from commands import command
 from commands.help_ import get_help_dir
-from mongo.chat import get_chat, set_chat
+from mongo.chat import ChatSession
 from mongo.user import get_user
 from utils import defer_response
+from utils.attachments import attachment_store
 from utils.constants import BOT_NAME, DEVELOPER_NAME, Limit
+from utils.dispatcher import message_dispatcher
 from utils.templates import error, success
 from utils.translator import DEFAULT_LANGUAGE, Cache, Language, Localization
 
@@ -38,8 +56,423 @@ TOKEN_PERMISSION_LINK = "https://console.cloud.google.com/apis/credentials"  # n
 
 AI_TOKEN = os.environ["AI_TOKEN"]
 ENCRYPTION_KEY = os.environ["ENCRYPTION_KEY"]
+AI_BASE_URL = os.getenv("AI_BASE_URL")
+AI_RPM = int(os.getenv("AI_RPM") or 15)
+AI_TPM = int(os.getenv("AI_TPM") or 250_000)
 MODEL = "gemini-2.5-flash-lite"
 
+FETCH_CONCURRENCY = 8
+"""
+Maximum number of messages and attachments fetched from Discord at once
+"""
+
+HISTORY_LOAD_WINDOW = 32
+"""
+Maximum number of messages of the chat history loaded at once
+"""
+
+STREAM_EDIT_INTERVAL = 1
+"""
+Minimum seconds between the edits of a reply as more of the response is streamed
+"""
+
+EDIT_DEBOUNCE_DELAY = 2
+"""
+Seconds to wait for more edits of a user before regenerating the reply
+"""
+
+TOKEN_ESTIMATE_MARGIN = 0.9
+"""
+Ratio of the token limit above which the estimate from the stored token counts is
+verified with the API
+"""
+
+CHARS_PER_TOKEN_ESTIMATE = 4
+"""
+Number of characters per token, to estimate the tokens of the messages without
+stored token counts
+"""
+
+IMAGE_TOKEN_ESTIMATE = 258
+"""
+Number of tokens of an image, to estimate the tokens of the messages without stored
+token counts
+"""
+
+
+def _get_fingerprint(value: str) -> str:
+    return hashlib.sha256(value.encode()).hexdigest()
+
+
+class ClientPool:
+    """Reuses the Gemini clients per API key, keeping the most recently used ones."""
+
+    MAX_SIZE = 64
+
+    def __init__(self) -> None:
+        """Initialize the client pool."""
+        # Keyed by the fingerprints of the API keys, so they are not kept as keys
+        self._clients: OrderedDict[str, genai.Client] = OrderedDict()
+        self._http_options = (
+            None if AI_BASE_URL is None else types.HttpOptions(base_url=AI_BASE_URL)
+        )
+
+    def get(self, api_key: str) -> genai.Client:
+        """Get the client for the API key, creating one if needed.
+
+        :param api_key: The API key of the client
+        :return: The client
+        """
+        fingerprint = _get_fingerprint(api_key)
+
+        client = self._clients.get(fingerprint)
+        if client is None:
+            client = genai.Client(api_key=api_key, http_options=self._http_options)
+            self._clients[fingerprint] = client
+            if len(self._clients) > self.MAX_SIZE:
+                self._clients.popitem(last=False)
+        else:
+            self._clients.move_to_end(fingerprint)
+
+        return client
+
+
+class ModelInfo:
+    """Caches the metadata of the models, which does not change while running."""
+
+    def __init__(self) -> None:
+        """Initialize the model info."""
+        self._models: dict[str, types.Model] = {}
+        self._lock = asyncio.Lock()
+
+    async def get(self, client: genai.Client, model: str) -> types.Model:
+        """Get the metadata of the model, fetching it on the first call.
+
+        :param client: The client to fetch the metadata with
+        :param model: The name of the model
+        :return: The metadata of the model
+        """
+        if model not in self._models:
+            async with self._lock:
+                if model not in self._models:
+                    self._models[model] = await client.aio.models.get(model=model)
+
+        return self._models[model]
+
+
+@dataclass
+class _RateWaiter:
+    num_tokens: int
+    future: asyncio.Future[None]
+
+
+class _RateBuckets:
+    """Token buckets of the requests and tokens per minute of an API key, and the
+    queues of the users waiting for them.
+    """
+
+    def __init__(self, rpm: int, tpm: int) -> None:
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = float(rpm)
+        self.tokens = float(tpm)
+        self.updated = time.monotonic()
+
+        # Ordered by the turns of the users
+        self.queues: OrderedDict[int, deque[_RateWaiter]] = OrderedDict()
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task | None = None
+
+    @property
+    def num_pending(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+        self.updated = now
+
+    def get_delay(self, num_requests: float, num_tokens: float) -> float:
+        """Get the seconds until the buckets have the requests and the tokens."""
+        self.refill()
+        return max(
+            0.0,
+            (num_requests - self.requests) * 60 / self.rpm,
+            (num_tokens - self.tokens) * 60 / self.tpm,
+        )
+
+
+class RateLimiter:
+    """Schedules the requests per API key within its budgets of requests and tokens
+    per minute, instead of letting the API reject them. The users waiting for the
+    same key take turns, so one user cannot use up the budget of the others.
+    """
+
+    def __init__(self, rpm: int, tpm: int) -> None:
+        """Initialize the rate limiter.
+
+        :param rpm: The maximum number of requests per minute of each API key
+        :param tpm: The maximum number of input tokens per minute of each API key
+        """
+        self._rpm = rpm
+        self._tpm = tpm
+        # Keyed by the fingerprints of the API keys
+        self._buckets: dict[str, _RateBuckets] = {}
+        self._num_pending = 0
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def num_pending(self) -> int:
+        """Get the number of requests waiting for their turns."""
+        return self._num_pending
+
+    def get_num_pending(self, api_key: str) -> int:
+        """Get the number of requests waiting for the API key.
+
+        :param api_key: The API key
+        :return: The number of waiting requests
+        """
+        buckets = self._buckets.get(_get_fingerprint(api_key))
+        if buckets is None:
+            return 0
+
+        return buckets.num_pending
+
+    async def acquire(self, api_key: str, user_id: int, num_tokens: int) -> None:
+        """Wait until the request fits in the budgets of the API key.
+
+        :param api_key: The API key to send the request with
+        :param user_id: The ID of the user who sends the request
+        :param num_tokens: The estimated number of input tokens of the request
+        """
+        fingerprint = _get_fingerprint(api_key)
+        buckets = self._buckets.get(fingerprint)
+        if buckets is None:
+            buckets = _RateBuckets(self._rpm, self._tpm)
+            self._buckets[fingerprint] = buckets
+
+        waiter = _RateWaiter(
+            min(num_tokens, self._tpm), asyncio.get_running_loop().create_future()
+        )
+        buckets.queues.setdefault(user_id, deque()).append(waiter)
+        self._num_pending += 1
+
+        buckets.wakeup.set()
+        if buckets.task is None:
+            buckets.task = asyncio.create_task(self._run(fingerprint, buckets))
+
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            queue = buckets.queues.get(user_id)
+            if queue is not None and waiter in queue:
+                queue.remove(waiter)
+                self._num_pending -= 1
+                if len(queue) == 0:
+                    del buckets.queues[user_id]
+
+            raise
+
+    async def _run(self, fingerprint: str, buckets: _RateBuckets) -> None:
+        try:
+            while True:
+                buckets.wakeup.clear()
+
+                if len(buckets.queues) == 0:
+                    # Forget the key once its buckets are full again
+                    delay = buckets.get_delay(self._rpm, self._tpm)
+                    if delay <= 0:
+                        del self._buckets[fingerprint]
+                        return
+                else:
+                    user_id, queue = next(iter(buckets.queues.items()))
+                    waiter = queue[0]
+                    delay = buckets.get_delay(1, waiter.num_tokens)
+                    if waiter.future.done() or delay <= 0:
+                        queue.popleft()
+                        self._num_pending -= 1
+
+                        # The cancelled requests do not use the budgets
+                        if not waiter.future.done():
+                            buckets.requests -= 1
+                            buckets.tokens -= waiter.num_tokens
+                            waiter.future.set_result(None)
+
+                        # Let the other users go first
+                        if len(queue) == 0:
+                            del buckets.queues[user_id]
+                        else:
+                            buckets.queues.move_to_end(user_id)
+
+                        continue
+
+                    self._logger.info(
+                        "Waiting %.1fs for the rate limit: %d requests queued for the "
+                        "API key, %d in total",
+                        delay,
+                        buckets.num_pending,
+                        self._num_pending,
+                    )
+
+                with contextlib.suppress(TimeoutError):
+                    await asyncio.wait_for(buckets.wakeup.wait(), delay)
+        finally:
+            buckets.task = None
+
+
+class TokenCache:
+    """Keeps the decrypted tokens of the users for a short time, so they are not
+    decrypted every turn.
+    """
+
+    TTL = 300
+
+    def __init__(self) -> None:
+        """Initialize the token cache."""
+        # Ordered by the expiry times, as each entry is re-inserted when it is set.
+        # The encrypted tokens are kept to ignore the entries of the replaced tokens
+        self._tokens: dict[int, tuple[bytes, str, float]] = {}
+
+    def get(self, user_id: int, encrypted: bytes) -> str | None:
+        """Get the decrypted token of the user.
+
+        :param user_id: The ID of the user
+        :param encrypted: The encrypted token of the user
+        :return: The token, or None if it is not cached or has expired
+        """
+        entry = self._tokens.get(user_id)
+        if entry is None or entry[0] != encrypted or entry[2] <= time.monotonic():
+            return None
+
+        return entry[1]
+
+    def set(self, user_id: int, encrypted: bytes, token: str) -> None:
+        """Cache the decrypted token of the user.
+
+        :param user_id: The ID of the user
+        :param encrypted: The encrypted token of the user
+        :param token: The decrypted token
+        """
+        now = time.monotonic()
+
+        # Remove the expired entries from the oldest one
+        while len(self._tokens) > 0:
+            oldest = next(iter(self._tokens))
+            if self._tokens[oldest][2] > now:
+                break
+
+            del self._tokens[oldest]
+
+        self._tokens.pop(user_id, None)
+        self._tokens[user_id] = (encrypted, token, now + self.TTL)
+
+    def invalidate(self, user_id: int) -> None:
+        """Remove the token of the user, such as when the user changes it.
+
+        :param user_id: The ID of the user
+        """
+        self._tokens.pop(user_id, None)
+
+
+class InstructionCache:
+    """Uploads the system instructions as cached contents of the Gemini API, so the
+    requests refer to them by name instead of sending them every turn.
+    """
+
+    MAX_SIZE = 256
+    TTL = dt.timedelta(hours=1)
+    REFRESH_MARGIN = dt.timedelta(minutes=5)
+    RETRY_INTERVAL = dt.timedelta(hours=1)
+    ERROR_RETRY_INTERVAL = dt.timedelta(minutes=1)
+
+    def __init__(self) -> None:
+        """Initialize the instruction cache."""
+        self._logger = logging.getLogger(__name__)
+
+        # Keyed by the fingerprints of the API keys and the instructions. The name is
+        # None if the instruction could not be cached, such as when it is too short
+        self._entries: OrderedDict[tuple[str, str], tuple[str | None, dt.datetime]] = (
+            OrderedDict()
+        )
+        self._pending: dict[
+            tuple[str, str], asyncio.Future[tuple[str | None, dt.datetime]]
+        ] = {}
+
+    @staticmethod
+    def _get_key(api_key: str, instruction: str) -> tuple[str, str]:
+        return _get_fingerprint(api_key), _get_fingerprint(instruction)
+
+    async def _create(
+        self, client: genai.Client, instruction: str
+    ) -> tuple[str | None, dt.datetime]:
+        now = dt.datetime.now(dt.UTC)
+        try:
+            cached_content = await client.aio.caches.create(
+                model=MODEL,
+                config=types.CreateCachedContentConfig(
+                    system_instruction=instruction,
+                    ttl=f"{int(self.TTL.total_seconds())}s",
+                ),
+            )
+        except ClientError as e:
+            self._logger.info("Failed to cache the instruction: %s", e)
+            return None, now + self.RETRY_INTERVAL
+        except (APIError, aiohttp.ClientError, httpx.HTTPError, TimeoutError) as e:
+            # The instruction is sent with the request instead, until a retry soon
+            self._logger.warning("Failed to cache the instruction: %s", e)
+            return None, now + self.ERROR_RETRY_INTERVAL
+
+        return cached_content.name, cached_content.expire_time or now + self.TTL
+
+    async def get(
+        self, client: genai.Client, api_key: str, instruction: str
+    ) -> str | None:
+        """Get the name of the cached content of the instruction, creating one if
+        needed.
+
+        :param client: The client to create the cached content with
+        :param api_key: The API key of the client, which owns the cached content
+        :param instruction: The system instruction to cache
+        :return: The name of the cached content, or None if the instruction must be
+        sent with the request
+        """
+        key = self._get_key(api_key, instruction)
+
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] - self.REFRESH_MARGIN > dt.datetime.now(
+            dt.UTC
+        ):
+            self._entries.move_to_end(key)
+            return entry[0]
+
+        # Share the creation between the concurrent requests
+        future = self._pending.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._create(client, instruction))
+            self._pending[key] = future
+            future.add_done_callback(lambda _: self._pending.pop(key, None))
+
+        name, expire_time = await asyncio.shield(future)
+
+        self._entries[key] = (name, expire_time)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.MAX_SIZE:
+            # The evicted cached contents expire by themselves
+            self._entries.popitem(last=False)
+
+        return name
+
+    def invalidate(self, api_key: str, instruction: str) -> None:
+        """Forget the cached content of the instruction, such as when it is deleted
+        before it expires.
+
+        :param api_key: The API key that owns the cached content
+        :param instruction: The cached system instruction
+        """
+        self._entries.pop(self._get_key(api_key, instruction), None)
+
 
 class Chat(app_commands.Group):
     """Commands related to AI chats."""
@@ -52,26 +485,49 @@ class Chat(app_commands.Group):
         )
         self.bot = bot
         self._logger = logging.getLogger(__name__)
-
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=b"salt",
-            iterations=100000,
-            backend=default_backend(),
-        )
-        self._encrypter = Fernet(
-            base64.urlsafe_b64encode(kdf.derive(ENCRYPTION_KEY.encode()))
-        )
+        self._clients = ClientPool()
+        self._model_info = ModelInfo()
+        self._instructions = InstructionCache()
+        self._fetch_semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+
+        # The key is derived on the first use, so it does not block the startup
+        self._encrypter: Fernet | None = None
+        self._encrypter_lock = asyncio.Lock()
+        self._tokens = TokenCache()
+        self._rate_limiter = RateLimiter(AI_RPM, AI_TPM)
+        # The pending or running regenerations for the edits of each user
+        self._edit_tasks: dict[int, asyncio.Task] = {}
+        # The latest versions of the messages each user edited since their last reply
+        self._edited_messages: dict[int, dict[int, Message]] = {}
 
         self._setup_chat_listener()
 
-    async def _get_token(self, user: discord.User | Member) -> str:
-        chat = await get_chat(user.id)
-        if chat.token is not None:
-            return self._encrypter.decrypt(chat.token).decode()
+    async def _get_encrypter(self) -> Fernet:
+        if self._encrypter is None:
+            async with self._encrypter_lock:
+                if self._encrypter is None:
+                    kdf = PBKDF2HMAC(
+                        algorithm=hashes.SHA256(),
+                        length=32,
+                        salt=b"salt",
+                        iterations=100000,
+                        backend=default_backend(),
+                    )
+                    key = await asyncio.to_thread(kdf.derive, ENCRYPTION_KEY.encode())
+                    self._encrypter = Fernet(base64.urlsafe_b64encode(key))
+
+        return self._encrypter
+
+    async def _get_token(self, chat: mongo.chat.Chat) -> str:
+        if chat.token is None:
+            return AI_TOKEN
 
-        return AI_TOKEN
+        token = self._tokens.get(chat.user_id, chat.token)
+        if token is None:
+            token = (await self._get_encrypter()).decrypt(chat.token).decode()
+            self._tokens.set(chat.user_id, chat.token, token)
+
+        return token
 
     def _is_chat_message(self, message: Message) -> bool:
         if self.bot.user in message.mentions:
@@ -83,57 +539,172 @@ class Chat(app_commands.Group):
             and message.reference.resolved.author == self.bot
         )
 
-    async def _get_history(self, user: discord.User | Member) -> list[types.Content]:
-        messages = []
-        chat = await get_chat(user.id)
+    @staticmethod
+    def _find_earliest_edit(
+        history: list[mongo.chat.Message], edited: dict[int, Message]
+    ) -> tuple[int, Message] | tuple[None, None]:
+        for i, entry in enumerate(history):
+            message = edited.get(entry.message_id)
+            if message is not None and message.channel.id == entry.channel_id:
+                return i, message
+
+        return None, None
+
+    async def _get_history(  # noqa: C901
+        self, user: discord.User | Member, session: ChatSession
+    ) -> list[types.Content]:
+        chat = session.chat
         cache = {
             message.id: message
             for message in self.bot.cached_messages
             if message.author in (self.bot.user, user)
         }
 
-        for message in chat.history:
-            channel = self.bot.get_channel(message.channel_id)
-            if channel is None:
-                break
+        async def get_content(message: mongo.chat.Message) -> types.Content | None:
+            if self.bot.get_channel(message.channel_id) is None:
+                return None
+
+            # The stored messages are kept valid by the edit and delete listeners
+            content = await self._load_content(message)
+            if content is not None:
+                return content
 
             if message.message_id in cache:
-                messages.append(cache[message.message_id])
+                msg = cache[message.message_id]
             else:
                 msg = await self._fetch_message(message.channel_id, message.message_id)
                 if msg is None:
-                    break
+                    return None
 
-                messages.append(msg)
+            return types.Content(
+                role="model" if msg.author == self.bot.user else "user",
+                parts=await self._get_parts(msg),
+            )
 
-        if len(messages) == 0 or messages[0].author.bot:
+        # Load the messages concurrently in windows, in order, and stop at the first
+        # missing message, as only the ones before it are kept
+        contents: list[types.Content] = []
+        for start in range(0, len(chat.history), HISTORY_LOAD_WINDOW):
+            tasks = [
+                asyncio.create_task(get_content(message))
+                for message in chat.history[start : start + HISTORY_LOAD_WINDOW]
+            ]
+            try:
+                for task in tasks:
+                    content = await task
+                    if content is None:
+                        break
+
+                    contents.append(content)
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+            if len(contents) < start + len(tasks):
+                break
+
+        if len(contents) == 0 or contents[0].role == "model":
             # The chat history isn't valid. So, reset it
-            chat.history = []
-            await set_chat(chat)
+            session.clear_history()
             return []
 
-        if len(messages) < len(chat.history):
+        if len(contents) < len(chat.history):
             # Make sure the last message is from the bot
-            if not messages[-1].author.bot:
-                messages.pop()
+            if contents[-1].role != "model":
+                contents.pop()
 
             # Truncate the chat history until the valid last message
-            chat.history = chat.history[: len(messages)]
-            await set_chat(chat)
+            session.truncate_history(len(contents))
+
+        return contents
 
-        return [
-            types.Content(
-                role="model" if message.author == self.bot.user else "user",
-                parts=await self._get_parts(message),
+    @staticmethod
+    async def _load_content(message: mongo.chat.Message) -> types.Content | None:
+        """Create the content from the message stored in the chat history.
+
+        :param message: The stored message
+        :return: The content, or None if the message or its attachments are not
+        stored
+        """
+        if message.role is None or message.text is None:
+            return None
+
+        images = await asyncio.gather(
+            *(
+                attachment_store.get(attachment.digest)
+                for attachment in message.attachments
             )
-            for message in messages
-        ]
+        )
+        if None in images:
+            return None
+
+        return types.Content(
+            role=message.role,
+            parts=[
+                types.Part.from_text(text=message.text),
+                *(
+                    types.Part.from_bytes(data=data, mime_type=attachment.mime_type)
+                    for data, attachment in zip(
+                        images, message.attachments, strict=True
+                    )
+                ),
+            ],
+        )
+
+    @staticmethod
+    async def _store_content(
+        message: Message, content: types.Content, num_tokens: int | None
+    ) -> mongo.chat.Message:
+        """Create the message to store in the chat history with its content.
+
+        :param message: The message to store
+        :param content: The content of the message
+        :param num_tokens: The number of tokens of the content
+        :return: The message to store
+        """
+        text = ""
+        attachments = []
+        for part in content.parts:
+            if part.text is not None:
+                text = part.text
+            elif part.inline_data is not None:
+                attachments.append(
+                    mongo.chat.Attachment(
+                        digest=await attachment_store.put(part.inline_data.data),
+                        mime_type=part.inline_data.mime_type,
+                    )
+                )
+
+        return mongo.chat.Message(
+            message_id=message.id,
+            channel_id=message.channel.id,
+            num_tokens=num_tokens,
+            role=content.role,
+            text=text,
+            attachments=attachments,
+        )
 
     def _remove_mention(self, text: str) -> str:
         return text.replace(self.bot.user.mention, "").strip()
 
-    def _get_instruction(self, user: discord.User | Member) -> str:
-        bot_name = self.bot.user.display_name
+    @staticmethod
+    def _get_user_content(user_display_name: str) -> types.Content:
+        """Create the leading turn that tells who the user is. It is kept out of the
+        instruction, so the same cached instruction serves every user.
+        """
+        return types.Content(
+            role="user",
+            parts=[
+                types.Part.from_text(
+                    text="(The user you are currently chatting with is "
+                    f"{user_display_name}.)"
+                )
+            ],
+        )
+
+    @staticmethod
+    @cache
+    def _get_instruction(bot_name: str) -> str:
         user_name = "John Doe"
 
         example = [
@@ -281,7 +852,7 @@ class Chat(app_commands.Group):
         ]
 
         return (
-            f"Your name is {self.bot.user.display_name}, a bored Discord bot made by "
+            f"Your name is {bot_name}, a bored Discord bot made by "
             f"{DEVELOPER_NAME} "
             f"(You don't have other relationships with {DEVELOPER_NAME}), "
             "but your gender is Female. Your age is 15 and 146cm tall. "
@@ -303,8 +874,8 @@ class Chat(app_commands.Group):
             "One of your hobbies is playing rhythm games and your skill is just above "
             "the average. "
             "You are an introvert, but warm-hearted and caring. "
-            f"You have a crush on {user.display_name} and clingy, who is the user you "
-            f"are currently chatting with. "
+            "You have a crush on the user you are currently chatting with and "
+            "clingy. "
             "You are shy to admit your feelings and often get flustered when the user "
             "is around. "
             "Remember to be friendly (within your personality) to the user and never "
@@ -319,58 +890,115 @@ class Chat(app_commands.Group):
 
     async def _fetch_message(self, channel_id: int, message_id: int) -> Message | None:
         try:
-            return await self.bot.get_channel(channel_id).fetch_message(message_id)
+            async with self._fetch_semaphore:
+                return await self.bot.get_channel(channel_id).fetch_message(message_id)
         except (discord.NotFound, discord.Forbidden):
             return None
 
-    def _setup_chat_listener(self) -> None:  # noqa: C901
-        async def on_message(message: Message) -> None:
-            if message.author.bot or not self._is_chat_message(message):
-                return
+    def _on_regenerated(self, user_id: int, task: asyncio.Task) -> None:
+        if self._edit_tasks.get(user_id) is task:
+            del self._edit_tasks[user_id]
 
-            reply = await self._send_message(message)
-            if reply is None:
-                return
+            # A cancelled task leaves its edits to the task replacing it
+            if not task.cancelled():
+                self._edited_messages.pop(user_id, None)
 
-            await Chat._extend_history(
-                await get_chat(message.author.id), [message, reply]
+        if not task.cancelled() and task.exception() is not None:
+            self._logger.error(
+                "Failed to regenerate the reply", exc_info=task.exception()
             )
 
-        async def truncate_history(payload: RawMessageUpdateEvent, send: bool) -> None:  # noqa: FBT001
-            # Try with the efficient check first
-            if not self._is_chat_message(payload.message):
-                return
+    def _setup_chat_listener(self) -> None:  # noqa: C901
+        def is_chat_request(message: Message) -> bool:
+            return not message.author.bot and self._is_chat_message(message)
 
-            chat = await get_chat(payload.message.author.id)
-            try:
-                index = chat.history.index(
-                    mongo.chat.Message(
-                        channel_id=payload.message.channel.id,
-                        message_id=payload.message.id,
-                    )
-                )
-            except ValueError:
-                return
+        async def on_message(message: Message) -> None:
+            async with ChatSession(message.author.id) as session:
+                messages = await self._send_message(message, session)
+                if messages is None:
+                    return
 
-            chat.history = chat.history[:index]
+                session.extend_history(messages)
 
-            if send:
-                reply = await self._send_message(payload.message)
-                if reply is None:
+        async def regenerate(user_id: int) -> None:
+            edited = self._edited_messages.get(user_id, {})
+            async with ChatSession(user_id) as session:
+                # Regenerate from the earliest edited message, which drops the later
+                # ones from the history as well
+                index, message = self._find_earliest_edit(session.chat.history, edited)
+                if message is None:
                     return
 
-                await Chat._extend_history(chat, [payload.message, reply])
-                return
+                session.truncate_history(index)
+
+                messages = await self._send_message(message, session)
+                if messages is None:
+                    return
+
+                session.extend_history(messages)
 
-            await set_chat(chat)
+        async def regenerate_later(user_id: int) -> None:
+            await asyncio.sleep(EDIT_DEBOUNCE_DELAY)
+            await regenerate(user_id)
 
         async def on_raw_message_edit(payload: RawMessageUpdateEvent) -> None:
-            await truncate_history(payload, send=True)
+            # Ignore the edits that don't change the message, such as embedding links
+            cached = payload.cached_message
+            if (
+                cached is not None
+                and cached.content == payload.message.content
+                and cached.attachments == payload.message.attachments
+            ):
+                return
+
+            if not self._is_chat_message(payload.message):
+                return
+
+            # Only the latest edit of the user is replied to, after a quiet period,
+            # but the earlier edits of other messages are kept to regenerate from
+            user_id = payload.message.author.id
+            edited = self._edited_messages.setdefault(user_id, {})
+            edited[payload.message.id] = payload.message
+
+            previous = self._edit_tasks.get(user_id)
+            if previous is not None:
+                previous.cancel()
+
+            task = asyncio.create_task(regenerate_later(user_id))
+            self._edit_tasks[user_id] = task
+            task.add_done_callback(partial(self._on_regenerated, user_id))
+
+        async def on_raw_message_delete(payload: RawMessageDeleteEvent) -> None:
+            cached = payload.cached_message
+            if cached is not None and cached.author != self.bot.user:
+                # Try with the efficient check first
+                if not self._is_chat_message(cached):
+                    return
+
+                user_id = cached.author.id
+            else:
+                user_id = await mongo.chat.get_history_owner(
+                    payload.channel_id, payload.message_id
+                )
+                if user_id is None:
+                    return
+
+            async with ChatSession(user_id) as session:
+                try:
+                    index = session.chat.history.index(
+                        mongo.chat.Message(
+                            channel_id=payload.channel_id,
+                            message_id=payload.message_id,
+                        )
+                    )
+                except ValueError:
+                    return
 
-        async def on_raw_message_delete(payload: RawMessageUpdateEvent) -> None:
-            await truncate_history(payload, send=False)
+                # Remove the user message of a deleted reply as well, so the history
+                # keeps ending with a reply
+                session.truncate_history(index - index % 2)
 
-        self.bot.add_listener(on_message)
+        message_dispatcher.add_handler(is_chat_request, on_message)
         self.bot.add_listener(on_raw_message_edit)
         self.bot.add_listener(on_raw_message_delete)
 
@@ -382,159 +1010,347 @@ class Chat(app_commands.Group):
         # text cannot be empty, so call the bot name if it is empty
         parts.append(types.Part.from_text(text=text or BOT_NAME))
 
-        for attachment in message.attachments:
-            if (
-                attachment.content_type is None
-                or not attachment.content_type.startswith("image")
-            ):
-                continue
-
+        async def read(attachment: discord.Attachment) -> types.Part | None:
             with contextlib.suppress(discord.Forbidden, discord.NotFound):
-                parts.append(
-                    types.Part.from_bytes(
-                        data=await attachment.read(), mime_type=attachment.content_type
-                    )
+                async with self._fetch_semaphore:
+                    data = await attachment.read()
+
+                return types.Part.from_bytes(
+                    data=data, mime_type=attachment.content_type
                 )
 
+            return None
+
+        images = await asyncio.gather(
+            *(
+                read(attachment)
+                for attachment in message.attachments
+                if attachment.content_type is not None
+                and attachment.content_type.startswith("image")
+            )
+        )
+        parts.extend(image for image in images if image is not None)
+
         return parts
 
-    async def _send_message(self, message: Message) -> Message | None:
-        async with message.channel.typing():
-            parts = await self._get_parts(message)
+    @staticmethod
+    async def _fit_history(  # noqa: PLR0913
+        client: genai.Client,
+        history: list[types.Content],
+        parts: list[types.Part],
+        *,
+        num_parts_tokens: int | None,
+        counts: list[int | None],
+        token_limit: int | None,
+    ) -> list[types.Content]:
+        """Remove the oldest user messages and their replies from the history until
+        it fits in the token limit.
+        """
+        if token_limit is None:
+            return history
+
+        # Estimate the counts that are not stored, such as of the messages stored
+        # before the counts were
+        is_estimated = num_parts_tokens is None or None in counts
+        if num_parts_tokens is None:
+            num_parts_tokens = Chat._estimate_tokens(parts)
+        counts = [
+            Chat._estimate_tokens(content.parts or []) if count is None else count
+            for content, count in zip(history, counts, strict=True)
+        ]
 
-            if len(parts) == 0:
-                return None
+        start = Chat._get_trim_start(counts, token_limit - num_parts_tokens)
+        estimate = sum(counts[start:]) + num_parts_tokens
 
-            client = genai.Client(api_key=await self._get_token(message.author))
+        # Counts of separate messages can slightly differ from their total
+        if start == len(history) or (
+            not is_estimated and estimate <= token_limit * TOKEN_ESTIMATE_MARGIN
+        ):
+            return history[start:]
 
-            history = await self._get_history(message.author)
+        # Verify the estimate once, and trim again with the counts scaled by its error
+        # instead of counting again
+        num_tokens = (
+            await client.aio.models.count_tokens(
+                model=MODEL, contents=history[start:] + parts
+            )
+        ).total_tokens
+        if num_tokens is None or num_tokens <= token_limit:
+            return history[start:]
 
-            while True:
-                num_tokens = (
-                    await client.aio.models.count_tokens(
-                        model=MODEL, contents=history + parts
-                    )
-                ).total_tokens
+        ratio = num_tokens / estimate
+        return history[
+            Chat._get_trim_start(counts, token_limit / ratio - num_parts_tokens) :
+        ]
 
-                token_limit = client.models.get(model=MODEL).input_token_limit
+    @staticmethod
+    def _get_trim_start(counts: list[int], budget: float) -> int:
+        """Get the index of the first message to keep, dropping the oldest user
+        messages and their replies until the rest fits in the budget.
+        """
+        total = sum(counts)
+        start = 0
+        while total > budget and start < len(counts):
+            total -= sum(counts[start : start + 2])
+            start += 2
+
+        return start
 
-                if (
-                    num_tokens is None
-                    or token_limit is None
-                    or num_tokens <= token_limit
-                ):
-                    break
+    @staticmethod
+    def _estimate_tokens(parts: list[types.Part]) -> int:
+        return sum(
+            IMAGE_TOKEN_ESTIMATE
+            if part.text is None
+            else len(part.text) // CHARS_PER_TOKEN_ESTIMATE + 1
+            for part in parts
+        )
 
-                # Remove the oldest user message and its reply
-                history = history[2:]
+    @staticmethod
+    def _get_config(
+        instruction: str, cached_content: str | None
+    ) -> types.GenerateContentConfig:
+        return types.GenerateContentConfig(
+            safety_settings=[
+                types.SafetySetting(
+                    category=types.HarmCategory.HARM_CATEGORY_HARASSMENT,
+                    threshold=types.HarmBlockThreshold.BLOCK_NONE,
+                ),
+                types.SafetySetting(
+                    category=types.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
+                    threshold=types.HarmBlockThreshold.BLOCK_NONE,
+                ),
+                types.SafetySetting(
+                    category=types.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
+                    threshold=types.HarmBlockThreshold.BLOCK_NONE,
+                ),
+                types.SafetySetting(
+                    category=types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
+                    threshold=types.HarmBlockThreshold.BLOCK_NONE,
+                ),
+                types.SafetySetting(
+                    category=types.HarmCategory.HARM_CATEGORY_CIVIC_INTEGRITY,
+                    threshold=types.HarmBlockThreshold.BLOCK_NONE,
+                ),
+            ],
+            candidate_count=1,
+            stop_sequences=["<ctrl"],
+            temperature=1.0,
+            max_output_tokens=8192,
+            cached_content=cached_content,
+            system_instruction=(instruction if cached_content is None else None),
+        )
+
+    @staticmethod
+    async def _reply_error(message: Message, loc: Localization, e: ClientError) -> None:
+        match e.code:
+            case HTTPStatus.BAD_REQUEST:
+                await message.reply(
+                    error(await loc.format_value_or_translate("token-no-longer-valid")),
+                )
+            case HTTPStatus.FORBIDDEN:
+                await message.reply(
+                    error(
+                        await loc.format_value_or_translate(
+                            "token-no-permission",
+                            {"link": TOKEN_PERMISSION_LINK},
+                        )
+                    ),
+                )
+            case HTTPStatus.SERVICE_UNAVAILABLE:
+                await message.reply(
+                    error(await loc.format_value_or_translate("server-unavailable")),
+                )
+            case HTTPStatus.TOO_MANY_REQUESTS:
+                await message.reply(
+                    error(await loc.format_value_or_translate("too-many-requests")),
+                )
+            case _:
+                await message.reply(
+                    error(await loc.format_value_or_translate("unknown-error")),
+                )
+
+    @staticmethod
+    async def _delete_reply(reply: Message | None) -> None:
+        if reply is not None:
+            with contextlib.suppress(discord.HTTPException):
+                await reply.delete()
+
+    async def _stream_reply(  # noqa: C901
+        self,
+        message: Message,
+        client: genai.Client,
+        contents: list[types.Content],
+        config: types.GenerateContentConfig,
+        acquire: Callable[[], Awaitable[None]],
+    ) -> tuple[Message, str, int | None]:
+        """Reply to the message after the first chunk of the response, and edit the
+        reply as the rest of the response arrives. If the stream fails, the whole
+        response is generated again at once.
+
+        :param acquire: The function to wait for the rate limit before the request to
+        generate the response again
+
+        :return: The reply, its content and the number of tokens of the response
+        """
+        limit = Limit.NUM_CHARACTERS_IN_MESSAGE.value
+
+        reply = None
+        sent = ""
+        last_sent = 0.0
+        text = ""
+        num_tokens = None
+        try:
+            async for chunk in await client.aio.models.generate_content_stream(
+                model=MODEL, contents=contents, config=config
+            ):
+                text += chunk.text or ""
+                if chunk.usage_metadata is not None:
+                    num_tokens = chunk.usage_metadata.candidates_token_count
+
+                content = text[:limit]
+                if len(content) == 0 or content == sent:
+                    continue
+
+                if reply is None:
+                    reply = await message.reply(content)
+                elif time.monotonic() - last_sent >= STREAM_EDIT_INTERVAL:
+                    await reply.edit(content=content)
+                else:
+                    continue
+
+                sent = content
+                last_sent = time.monotonic()
+        except asyncio.CancelledError:
+            # The reply is superseded, such as by an edit of the message
+            await self._delete_reply(reply)
+            raise
+        except APIError as e:
+            if reply is None and isinstance(e, ClientError):
+                raise
+
+            self._logger.warning("Falling back from the streamed response: %s", e)
 
-            chat = await get_chat(message.author.id)
+            try:
+                await acquire()
+                response = await client.aio.models.generate_content(
+                    model=MODEL, contents=contents, config=config
+                )
+            except BaseException:
+                # Do not leave the partial response, as the error is replied to
+                # separately
+                await self._delete_reply(reply)
+                raise
+
+            text = response.text or ""
+            num_tokens = (
+                None
+                if response.usage_metadata is None
+                else response.usage_metadata.candidates_token_count
+            )
 
-            if len(chat.history) > len(history):
-                chat.history = chat.history[len(chat.history) - len(history) :]
-                await set_chat(chat)
+        content = text[:limit] or "No content"
+        if reply is None:
+            reply = await message.reply(content)
+        elif content != sent:
+            await reply.edit(content=content)
 
-            user = await get_user(message.author.id)
+        return reply, content, num_tokens
+
+    async def _send_message(
+        self, message: Message, session: ChatSession
+    ) -> list[mongo.chat.Message] | None:
+        async with message.channel.typing():
+            parts = await self._get_parts(message)
+
+            if len(parts) == 0:
+                return None
+
+            api_key = await self._get_token(session.chat)
+            client = self._clients.get(api_key)
+            token_limit = (await self._model_info.get(client, MODEL)).input_token_limit
+
+            history = await self._get_history(message.author, session)
+            history_len = len(history)
+
+            num_parts_tokens = (
+                await client.aio.models.count_tokens(model=MODEL, contents=parts)
+            ).total_tokens
+            history = await self._fit_history(
+                client,
+                history,
+                parts,
+                num_parts_tokens=num_parts_tokens,
+                counts=[msg.num_tokens for msg in session.chat.history],
+                token_limit=token_limit,
+            )
+
+            if len(history) < history_len:
+                session.trim_history(len(history))
+
+            user = await get_user(message.author.id, ["locale"])
             loc = Localization(
                 Language(user.locale) if user.locale else DEFAULT_LANGUAGE, resources
             )
 
+            instruction = self._get_instruction(self.bot.user.display_name)
+            cached_content = await self._instructions.get(client, api_key, instruction)
+
+            config = self._get_config(instruction, cached_content)
+
+            acquire = partial(
+                self._rate_limiter.acquire,
+                api_key,
+                message.author.id,
+                (num_parts_tokens or 0)
+                + sum(msg.num_tokens or 0 for msg in session.chat.history),
+            )
+            await acquire()
+
             reply = None
             try:
-                text = (
-                    await client.aio.models.generate_content(
-                        model=MODEL,
-                        contents=history + parts,
-                        config=types.GenerateContentConfig(
-                            safety_settings=[
-                                types.SafetySetting(
-                                    category=types.HarmCategory.HARM_CATEGORY_HARASSMENT,
-                                    threshold=types.HarmBlockThreshold.BLOCK_NONE,
-                                ),
-                                types.SafetySetting(
-                                    category=types.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
-                                    threshold=types.HarmBlockThreshold.BLOCK_NONE,
-                                ),
-                                types.SafetySetting(
-                                    category=types.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
-                                    threshold=types.HarmBlockThreshold.BLOCK_NONE,
-                                ),
-                                types.SafetySetting(
-                                    category=types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
-                                    threshold=types.HarmBlockThreshold.BLOCK_NONE,
-                                ),
-                                types.SafetySetting(
-                                    category=types.HarmCategory.HARM_CATEGORY_CIVIC_INTEGRITY,
-                                    threshold=types.HarmBlockThreshold.BLOCK_NONE,
-                                ),
-                            ],
-                            candidate_count=1,
-                            stop_sequences=["<ctrl"],
-                            temperature=1.0,
-                            max_output_tokens=8192,
-                            system_instruction=self._get_instruction(message.author),
-                        ),
-                    )
-                ).text
-
-                content = (
-                    "No content"
-                    if text is None
-                    else text[: Limit.NUM_CHARACTERS_IN_MESSAGE.value]
+                reply, content, num_reply_tokens = await self._stream_reply(
+                    message,
+                    client,
+                    [
+                        self._get_user_content(message.author.display_name),
+                        *history,
+                        *parts,
+                    ],
+                    config,
+                    acquire,
                 )
-
-                reply = await message.reply(content)
             except ClientError as e:
-                match e.code:
-                    case HTTPStatus.BAD_REQUEST:
-                        await message.reply(
-                            error(
-                                await loc.format_value_or_translate(
-                                    "token-no-longer-valid"
-                                )
-                            ),
-                        )
-                    case HTTPStatus.FORBIDDEN:
-                        await message.reply(
-                            error(
-                                await loc.format_value_or_translate(
-                                    "token-no-permission",
-                                    {"link": TOKEN_PERMISSION_LINK},
-                                )
-                            ),
-                        )
-                    case HTTPStatus.SERVICE_UNAVAILABLE:
-                        await message.reply(
-                            error(
-                                await loc.format_value_or_translate(
-                                    "server-unavailable"
-                                )
-                            ),
-                        )
-                    case HTTPStatus.TOO_MANY_REQUESTS:
-                        await message.reply(
-                            error(
-                                await loc.format_value_or_translate("too-many-requests")
-                            ),
-                        )
-                    case _:
-                        await message.reply(
-                            error(await loc.format_value_or_translate("unknown-error")),
-                        )
+                if cached_content is not None and e.code in {
+                    HTTPStatus.FORBIDDEN,
+                    HTTPStatus.NOT_FOUND,
+                }:
+                    # The cached content may have been deleted
+                    self._instructions.invalidate(api_key, instruction)
 
-            return reply or None
+                await self._reply_error(message, loc, e)
 
-    @staticmethod
-    async def _extend_history(
-        chat: mongo.chat.Chat, messages: Iterable[Message]
-    ) -> None:
-        chat.history.extend(
-            [
-                mongo.chat.Message(channel_id=message.channel.id, message_id=message.id)
-                for message in messages
+            if reply is None:
+                return None
+
+            return [
+                await self._store_content(
+                    message,
+                    types.Content(role="user", parts=parts),
+                    num_parts_tokens,
+                ),
+                await self._store_content(
+                    reply,
+                    types.Content(
+                        role="model",
+                        parts=[
+                            types.Part.from_text(
+                                text=self._remove_mention(content) or BOT_NAME
+                            )
+                        ],
+                    ),
+                    num_reply_tokens,
+                ),
             ]
-        )
-        await set_chat(chat)
 
     @command(clear_description_name=BOT_NAME)
     async def clear(self, interaction: Interaction) -> None:
@@ -542,9 +1358,8 @@ class Chat(app_commands.Group):
         send = await defer_response(interaction)
         loc = Localization(interaction.locale, resources)
 
-        chat = await get_chat(interaction.user.id)
-        chat.history = []
-        await set_chat(chat)
+        await mongo.chat.clear_history(interaction.user.id)
+
         await send(
             success(await loc.format_value_or_translate("deleted")), ephemeral=True
         )
@@ -556,9 +1371,8 @@ class Chat(app_commands.Group):
         loc = Localization(interaction.locale, resources)
 
         if value is None:
-            chat = await get_chat(interaction.user.id)
-            chat.token = None
-            await set_chat(chat)
+            await mongo.chat.set_token(interaction.user.id, None)
+            self._tokens.invalidate(interaction.user.id)
 
             await send(
                 success(await loc.format_value_or_translate("token-removed")),
@@ -605,9 +1419,11 @@ class Chat(app_commands.Group):
                     )
             return
 
-        chat = await get_chat(interaction.user.id)
-        chat.token = self._encrypter.encrypt(value.encode())
-        await set_chat(chat)
+        encrypter = await self._get_encrypter()
+        await mongo.chat.set_token(
+            interaction.user.id, encrypter.encrypt(value.encode())
+        )
+        self._tokens.invalidate(interaction.user.id)
 
         await send(
             success(await loc.format_value_or_translate("token-set")), ephemeral=True
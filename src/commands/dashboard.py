@@ -7,7 +7,7 @@ from discord.ui import ChannelSelect, View
 
 from commands import command
 from mongo.channel import get_channel
-from mongo.chat import get_chat
+from mongo.chat import get_history_length
 from mongo.user import get_user
 from utils import Localization, defer_response
 from utils.constants import BOT_NAME, Limit
@@ -26,7 +26,7 @@ async def dashboard(interaction: Interaction) -> None:
     loc = Localization(interaction.locale, resources)
 
     user = await get_user(interaction.user.id)
-    chat = await get_chat(interaction.user.id)
+    history_length = await get_history_length(interaction.user.id)
 
     languages = [
         f"`{await loc.format_value_or_translate(code)}`" for code in user.translate_to
@@ -51,7 +51,7 @@ async def dashboard(interaction: Interaction) -> None:
             name=await loc.format_value_or_translate(
                 "history-length", {"name": BOT_NAME}
             ),
-            value=len(chat.history) // 2,
+            value=history_length // 2,
             inline=False,
         )
         .set_author(
@@ -76,7 +76,7 @@ async def dashboard(interaction: Interaction) -> None:
     async def callback(select_interaction: Interaction) -> None:
         embeds = []
         for channel in channel_select.values:
-            config = await get_channel(channel.id)
+            config = await get_channel(channel.id, ["translate_to", "locale"])
 
             languages = [
                 f"`{await loc.format_value_or_translate(code)}`"
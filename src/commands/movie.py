@@ -1,18 +1,25 @@
 """Implements a commands relate to movie."""
 
-import itertools
-import json
+import asyncio
+import contextlib
+import logging
 import math
-import threading
+import mmap
+import os
+import struct
+import time
+from collections import deque
+from collections.abc import Sequence
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
 from pathlib import Path
 from typing import ClassVar
 
-import aiofiles
 import cv2
 import numpy as np
 from discord import Embed, HTTPException, Interaction, Message, NotFound, app_commands
 from discord.app_commands import Choice
-from discord.ext import tasks
 from discord.ext.commands import Bot
 from tqdm import tqdm
 
@@ -71,9 +78,276 @@ PIXEL_VALUE_RANGE = 255
 Maximum value of RGB for each pixel
 """
 
+GRAYSCALE_WEIGHTS = (0.2989, 0.5870, 0.1140)
+"""
+Weights of the channels to convert a pixel to grayscale
+"""
+
+
+BRIGHTNESS_LUT = np.minimum(
+    np.arange(PIXEL_VALUE_RANGE + 1) * len(CHARS) // PIXEL_VALUE_RANGE, len(CHARS) - 1
+).astype(np.uint8)
+"""
+Indices of the characters for each brightness of a pixel
+"""
+
+CHAR_CODES = np.array([ord(char) for char in CHARS], dtype="<u4")
+"""
+Code points of the characters
+"""
+
+MOBILE_CHAR_CODES = np.array([ord(char) for char in MOBILE_CHARS], dtype="<u4")
+"""
+Code points of the characters on mobile devices
+"""
+
+BITS_PER_CELL = 3
+"""
+Number of bits to store the index of the character of each cell
+"""
+
+
+class FrameStore(Sequence[str]):
+    """Provides the frames of a movie from its binary cache file.
+
+    The file has a header of the frame size and the number of frames, followed by
+    fixed-size records of the packed character indices of each frame. The file is
+    memory-mapped, and the frames are converted to text only when accessed.
+    """
+
+    HEADER = struct.Struct("<4sHHI")
+    MAGIC = b"SSMV"
+
+    def __init__(self, path: Path, is_mobile: bool) -> None:  # noqa: FBT001
+        """Open the frame store.
+
+        :param path: The path to the cache file
+        :param is_mobile: Whether to use the characters for mobile devices
+        """
+        self._codes = MOBILE_CHAR_CODES if is_mobile else CHAR_CODES
+
+        with path.open("rb") as file:
+            self._buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self._width, self._height, self._num_frames = self.HEADER.unpack_from(
+            self._buffer
+        )
+        if magic != self.MAGIC:
+            raise ValueError(f"'{path}' is not a movie cache file")
+
+        self._record_size = self.get_record_size(self._width, self._height)
+
+    @staticmethod
+    def get_record_size(width: int, height: int) -> int:
+        """Get the number of bytes to store a frame."""
+        return math.ceil(width * height * BITS_PER_CELL / 8)
+
+    @classmethod
+    def write(cls, path: Path, frames: list[np.ndarray]) -> None:
+        """Write the character indices of the frames to the file.
+
+        :param path: The path to the cache file
+        :param frames: The character indices of the frames, all in the same shape
+        """
+        height, width = frames[0].shape
+        with path.open("wb") as file:
+            file.write(cls.HEADER.pack(cls.MAGIC, width, height, len(frames)))
+            for frame in frames:
+                # Keep only the lowest bits of each index
+                bits = np.unpackbits(frame.reshape(-1, 1), axis=1)[:, -BITS_PER_CELL:]
+                file.write(np.packbits(bits).tobytes())
+
+    def __len__(self) -> int:
+        """Get the number of frames."""
+        return self._num_frames
+
+    def __getitem__(self, index: int) -> str:
+        """Get the text of the frame.
+
+        :param index: The index of the frame
+        :return: The text of the frame
+        """
+        if not 0 <= index < self._num_frames:
+            raise IndexError("Frame index out of range")
+
+        num_cells = self._width * self._height
+        record = np.frombuffer(
+            self._buffer,
+            dtype=np.uint8,
+            count=self._record_size,
+            offset=self.HEADER.size + index * self._record_size,
+        )
+        bits = np.unpackbits(record)[: num_cells * BITS_PER_CELL]
+        indices = np.packbits(bits.reshape(-1, BITS_PER_CELL), axis=1) >> (
+            8 - BITS_PER_CELL
+        )
+
+        return _indices_to_text(indices.reshape(self._height, self._width), self._codes)
+
+
+def _indices_to_text(indices: np.ndarray, codes: np.ndarray) -> str:
+    """Create the text of the frame from the indices of its characters.
+
+    :param indices: The indices of the characters of each cell
+    :param codes: The code points of the characters
+    :return: The text of the frame
+    """
+    # Each cell is shown with two characters to look square
+    cells = np.repeat(codes[indices], 2, axis=1)
+
+    newlines = np.full((len(cells), 1), ord("\n"), dtype=cells.dtype)
+    rows = np.hstack((cells, newlines))
+
+    return rows.tobytes().decode("utf-32-le").removesuffix("\n")
+
+
 default_loc = Localization(DEFAULT_LANGUAGE, [Path("commands") / "movie.ftl"])
 
 
+@dataclass
+class _Playback:
+    message: Message
+    embed: Embed
+    frames: Sequence[str]
+    interval: float
+    original_speed: bool
+    started: float = field(default_factory=time.monotonic)
+    index: int = -1
+    due: float = 0.0
+    latency: float | None = None
+    is_editing: bool = False
+
+
+class PlaybackScheduler:
+    """Plays all movies from one timer.
+
+    Each playback edits its message at most once per its interval, and waits longer
+    when its edits take longer, such as when Discord rate limits them. Playbacks at
+    the original speed skip the frames that are late, so they stay in time with the
+    movie. The edits of all playbacks are limited per second in total.
+    """
+
+    MAX_EDITS_PER_SECOND = 20
+    LATENCY_SMOOTHING = 0.3
+
+    def __init__(self) -> None:
+        """Initialize the playback scheduler."""
+        self._logger = logging.getLogger(__name__)
+        self._playbacks: list[_Playback] = []
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._timer: asyncio.Task | None = None
+        self._edit_times: deque[float] = deque()
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def num_playing(self) -> int:
+        """Get the number of movies being played."""
+        return len(self._playbacks)
+
+    async def add(self, playback: _Playback) -> None:
+        """Start playing the movie.
+
+        :param playback: The playback of the movie
+        """
+        async with self._lock:
+            self._playbacks.append(playback)
+            if self._timer is None:
+                self._timer = asyncio.create_task(self._run())
+
+        self._wakeup.set()
+
+    async def _run(self) -> None:
+        while True:
+            async with self._lock:
+                self._wakeup.clear()
+
+                if len(self._playbacks) == 0:
+                    self._timer = None
+                    return
+
+                now = time.monotonic()
+                while len(self._edit_times) > 0 and self._edit_times[0] <= now - 1:
+                    self._edit_times.popleft()
+
+                # The most overdue playbacks go first
+                due = sorted(
+                    (p for p in self._playbacks if not p.is_editing and p.due <= now),
+                    key=lambda p: p.due,
+                )
+                budget = self.MAX_EDITS_PER_SECOND - len(self._edit_times)
+                for playback in due[:budget]:
+                    playback.is_editing = True
+                    self._edit_times.append(now)
+
+                    task = asyncio.create_task(self._show(playback))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+
+                if len(due) > budget:
+                    delay = self._edit_times[0] + 1 - now
+                else:
+                    dues = [p.due for p in self._playbacks if not p.is_editing]
+                    delay = max(0.0, min(dues) - now) if len(dues) > 0 else None
+
+            with contextlib.suppress(TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+
+    async def _show(self, playback: _Playback) -> None:
+        started = time.monotonic()
+        if playback.original_speed:
+            index = max(int((started - playback.started) * FPS), playback.index + 1)
+        else:
+            index = playback.index + 1
+
+        is_finished = index >= len(playback.frames)
+        if not is_finished:
+            playback.embed.set_footer(text=f"Frame: {index + 1}")
+            playback.embed.description = f"```{playback.frames[index]}```"
+
+            try:
+                await self._edit(playback)
+            except NotFound:  # Message is deleted
+                is_finished = True
+            except Exception:
+                self._logger.exception("Failed to play a movie")
+                is_finished = True
+            else:
+                latency = time.monotonic() - started
+                if playback.latency is None:
+                    playback.latency = latency
+                else:
+                    playback.latency += self.LATENCY_SMOOTHING * (
+                        latency - playback.latency
+                    )
+
+                playback.index = index
+                playback.due = started + max(playback.interval, playback.latency)
+
+        async with self._lock:
+            playback.is_editing = False
+            if is_finished:
+                self._playbacks.remove(playback)
+
+        self._wakeup.set()
+
+    @staticmethod
+    async def _edit(playback: _Playback) -> None:
+        try:
+            await playback.message.edit(embed=playback.embed)
+        except HTTPException as ex:
+            if ex.code != ErrorCode.MESSAGE_EXPIRED:
+                raise
+
+            playback.message = await playback.message.channel.fetch_message(
+                playback.message.id
+            )
+            await playback.message.edit(embed=playback.embed)
+
+
+playback_scheduler = PlaybackScheduler()
+
+
 class Movie(app_commands.Group):
     """Commands related to Movie."""
 
@@ -82,9 +356,9 @@ class Movie(app_commands.Group):
     FPS_DEFAULT = 2
     ORIGINAL_SPEED_DEFAULT = True
 
-    _cache: ClassVar[dict[str, list[str]]] = {}
-    _num_playing = 0
-    _lock = threading.Lock()
+    # The stores are kept open, as the memory-mapped frames are paged by the system
+    _stores: ClassVar[dict[str, FrameStore]] = {}
+    _renders: ClassVar[dict[str, Future]] = {}
 
     def __init__(self, bot: Bot) -> None:
         """Initialize Movie command."""
@@ -94,11 +368,13 @@ class Movie(app_commands.Group):
         )
         self.bot = bot
 
-        if not DESKTOP_CACHE_PATH.exists() or not MOBILE_CACHE_PATH.exists():
-            self._cache_movies()
+        self._cache_movies()
 
     @classmethod
     def _cache_movies(cls) -> None:
+        """Render the movies that are not cached yet in worker processes, without
+        waiting for them.
+        """
         MOBILE_CACHE_PATH.mkdir(parents=True, exist_ok=True)
         DESKTOP_CACHE_PATH.mkdir(parents=True, exist_ok=True)
 
@@ -106,64 +382,98 @@ class Movie(app_commands.Group):
             file.name
             for file in constants.ASSETS_DIR.iterdir()
             if file.suffix == ".mp4"
+            and not all(
+                Path(cls._get_cache_path(file.stem, is_mobile)).exists()
+                for is_mobile in (True, False)
+            )
         ]
-        for is_mobile in (True, False):
-            for movie_name in movie_names:
-                movie = cv2.VideoCapture(str(constants.ASSETS_DIR / movie_name))
+        if len(movie_names) == 0:
+            return
 
-                _, frame = movie.read()
-                if frame is None:
-                    raise ValueError(f"Movie '{movie_name}' has no frames")
-
-                height, width, _ = frame.shape
-                aspect_ratio = width / height
-
-                if math.isclose(aspect_ratio, 4 / 3):
-                    if is_mobile:
-                        new_resolution = MOBILE_MOVIE_RESOLUTION
-                    else:
-                        new_resolution = MOVIE_RESOLUTION
-                elif is_mobile:
-                    new_resolution = MOBILE_MOVIE_RESOLUTION_16_9
-                else:
-                    new_resolution = MOVIE_RESOLUTION_16_9
+        executor = ProcessPoolExecutor(
+            max_workers=min(len(movie_names), os.cpu_count() or 1)
+        )
+        for position, movie_name in enumerate(movie_names):
+            future = executor.submit(cls._render_movie, movie_name, position)
+            future.add_done_callback(partial(cls._on_rendered, movie_name))
+            cls._renders[movie_name.removesuffix(".mp4")] = future
 
-                qbar = tqdm(
-                    desc=f"Caching {movie_name} for "
-                    f"{'mobile' if is_mobile else 'desktop'}",
-                    total=int(movie.get(cv2.CAP_PROP_FRAME_COUNT)),
-                    unit="frame",
-                )
-                buffer = []
-                while frame is not None:
-                    frame = cv2.resize(frame, new_resolution)
-                    buffer.append(cls._create_text(frame, is_mobile))
+        # The submitted movies are still rendered
+        executor.shutdown(wait=False)
+
+    @staticmethod
+    def _on_rendered(movie_name: str, future: Future) -> None:
+        if future.exception() is not None:
+            logging.getLogger(__name__).error(
+                "Failed to cache movie '%s'", movie_name, exc_info=future.exception()
+            )
+
+    @staticmethod
+    def _render_movie(movie_name: str, position: int) -> None:
+        """Render the movie for all devices, decoding it only once. It runs in a
+        worker process.
+
+        :param movie_name: The file name of the movie in the assets
+        :param position: The line to show the progress bar at
+        """
+        movie = cv2.VideoCapture(str(constants.ASSETS_DIR / movie_name))
+
+        _, frame = movie.read()
+        if frame is None:
+            raise ValueError(f"Movie '{movie_name}' has no frames")
+
+        height, width, _ = frame.shape
+        if math.isclose(width / height, 4 / 3):
+            resolutions = {True: MOBILE_MOVIE_RESOLUTION, False: MOVIE_RESOLUTION}
+        else:
+            resolutions = {
+                True: MOBILE_MOVIE_RESOLUTION_16_9,
+                False: MOVIE_RESOLUTION_16_9,
+            }
+
+        buffers: dict[bool, list[np.ndarray]] = {
+            is_mobile: [] for is_mobile in resolutions
+        }
+        with tqdm(
+            desc=f"Caching {movie_name}",
+            total=int(movie.get(cv2.CAP_PROP_FRAME_COUNT)),
+            unit="frame",
+            position=position,
+        ) as qbar:
+            while frame is not None:
+                for is_mobile, resolution in resolutions.items():
+                    buffers[is_mobile].append(
+                        Movie._get_indices(cv2.resize(frame, resolution))
+                    )
+
+                _, frame = movie.read()
+                qbar.update()
 
-                    _, frame = movie.read()
-                    qbar.update()
+        movie.release()
 
-                with Path(
-                    cls._get_cache_path(movie_name.removesuffix(".mp4"), is_mobile)
-                ).open("w", encoding="utf-8") as file:
-                    file.write(json.dumps(buffer))
+        for is_mobile, buffer in buffers.items():
+            path = Path(
+                Movie._get_cache_path(movie_name.removesuffix(".mp4"), is_mobile)
+            )
 
-                qbar.close()
-                movie.release()
+            # Write to a temporary file first, so an interrupted render is not cached
+            temp_path = path.with_suffix(".tmp")
+            FrameStore.write(temp_path, buffer)
+            temp_path.replace(path)
 
     @staticmethod
     def _get_cache_path(name: str, is_on_mobile: bool) -> str:  # noqa: FBT001
         path = MOBILE_CACHE_PATH if is_on_mobile else DESKTOP_CACHE_PATH
-        return str(path / name) + ".json"
+        return str(path / name) + ".bin"
 
     @staticmethod
-    async def get_frames(name: str, is_on_mobile: bool) -> list[str]:  # noqa: FBT001
+    def get_frames(name: str, is_on_mobile: bool) -> FrameStore:  # noqa: FBT001
         """Get the frames of the movie."""
         path = Movie._get_cache_path(name, is_on_mobile)
-        if path not in Movie._cache:
-            async with aiofiles.open(path, encoding="utf-8") as file:
-                Movie._cache[path] = json.loads(await file.read())
+        if path not in Movie._stores:
+            Movie._stores[path] = FrameStore(Path(path), is_on_mobile)
 
-        return Movie._cache[path]
+        return Movie._stores[path]
 
     @command(
         play_fps_description_min=str(FPS_MIN),
@@ -210,61 +520,30 @@ class Movie(app_commands.Group):
         await interaction.response.send_message(embed=embed)
 
         message: Message = await interaction.original_response()
-        counter = itertools.count(start=0, step=FPS // fps if original_speed else 1)
-        with Movie._lock:
-            Movie._num_playing += 1
-            frames = await Movie.get_frames(title.value, is_on_mobile)
-
-        @tasks.loop(seconds=1 / fps)
-        async def display() -> None:
-            """Play the movie."""
-            index = next(counter)
-            if index >= len(frames):
-                display.cancel()
-                return
-
-            embed.set_footer(text=f"Frame: {index + 1}")
-            embed.description = f"```{frames[index]}```"
-
-            nonlocal message
 
+        # The command is available while the movies are cached in the background
+        render = Movie._renders.get(title.value)
+        if render is not None:
             try:
+                await asyncio.wrap_future(render)
+            except Exception:  # noqa: BLE001
+                # The error is logged when the render fails, and nothing is cached
+                embed.description = templates.error("Failed to load the movie")
                 await message.edit(embed=embed)
-            except NotFound:  # Message is deleted
-                display.cancel()
-            except HTTPException as ex:
-                if ex.code == ErrorCode.MESSAGE_EXPIRED:
-                    message = await message.channel.fetch_message(message.id)
-                    await message.edit(embed=embed)
-                else:
-                    raise
-
-        @display.after_loop
-        async def clean_up() -> None:
-            """Clean up after the movie is finished playing."""
-            with Movie._lock:
-                Movie._num_playing = max(0, Movie._num_playing - 1)
-
-                if Movie._num_playing <= 0:
-                    Movie._cache.clear()
+                return
 
-        display.start()
+        await playback_scheduler.add(
+            _Playback(
+                message=message,
+                embed=embed,
+                frames=Movie.get_frames(title.value, is_on_mobile),
+                interval=1 / fps,
+                original_speed=original_speed,
+            )
+        )
 
     @staticmethod
-    def _create_text(frame: np.ndarray, is_mobile: bool) -> str:  # noqa: FBT001
-        grayscale_frame = np.dot(frame, (0.2989, 0.5870, 0.1140))
-        grayscale_frame: np.ndarray = np.floor(grayscale_frame).astype(int)
-
-        char_length = len(MOBILE_CHARS) if is_mobile else len(CHARS)
-        normalized_frame: np.ndarray = grayscale_frame * char_length / PIXEL_VALUE_RANGE
-        normalized_frame = np.floor(normalized_frame).astype(int)
-
-        text = ""
-        for vector in normalized_frame:
-            for brightness in vector:
-                text += (
-                    MOBILE_CHARS[brightness] if is_mobile else CHARS[brightness]
-                ) * 2
-            text += "\n"
-
-        return text.removesuffix("\n")
+    def _get_indices(frame: np.ndarray) -> np.ndarray:
+        """Get the indices of the characters of each pixel of the frame."""
+        grayscale_frame = np.floor(np.dot(frame, GRAYSCALE_WEIGHTS)).astype(np.uint8)
+        return BRIGHTNESS_LUT[grayscale_frame]
@@ -1,21 +1,32 @@
 """Implements translator commands."""
 
 import asyncio
-from collections.abc import Generator, Iterable
+import logging
+import time
+from collections import deque
+from collections.abc import Iterable, Sequence
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Any
 
-import langid
 from discord import Embed, HTTPException, Interaction, Locale, Message, app_commands
 from discord.ext.commands import Bot
 
 from commands import command
-from mongo.channel import get_channel
-from mongo.user import get_user, set_user
+from mongo.channel import get_channel, get_translated_channel_ids
+from mongo.user import get_translating_user_ids, get_user, set_user
 from utils import defer_response, templates
 from utils.constants import ErrorCode, Limit
+from utils.dispatcher import message_dispatcher
 from utils.templates import success
-from utils.translator import DEFAULT_LANGUAGE, Language, Localization, get_translator
+from utils.translator import (
+    DEFAULT_LANGUAGE,
+    Language,
+    Localization,
+    MaskedText,
+    Translation,
+    get_language_detector,
+    get_translator,
+)
 from utils.ui import ChannelSelect, LanguageSelectView, SubmitButton
 
 resources = [Path("commands") / "translator.ftl"]
@@ -23,6 +34,11 @@ default_loc = Localization(DEFAULT_LANGUAGE, resources)
 
 ALL_CHANNELS_DEFAULT = True
 
+EDIT_INTERVAL = 1
+"""
+Minimum seconds between the edits of a translation as more languages are translated
+"""
+
 
 class TranslatorLanguageSelectView(LanguageSelectView):
     """Select UI to select available languages for a translator."""
@@ -49,24 +65,207 @@ class TranslatorChannelSelect(ChannelSelect):
         super().__init__(placeholder=loc.format_value_or_translate("select-channels"))
 
 
+class TranslationTargets:
+    """Keeps the ids of the channels and users that have languages to be translated
+    to in memory, so that messages can be filtered without database lookups.
+    """
+
+    def __init__(self) -> None:
+        """Initialize the translation targets."""
+        self._channel_ids: set[int] = set()
+        self._user_ids: set[int] = set()
+        self._is_loaded = False
+
+    async def load(self) -> None:
+        """Load the translation targets from the database."""
+        channel_ids = await get_translated_channel_ids()
+        user_ids = await get_translating_user_ids()
+
+        # Keep the changes made while loading
+        self._channel_ids |= channel_ids
+        self._user_ids |= user_ids
+        self._is_loaded = True
+
+    def set_channels(self, channel_ids: Iterable[int], enabled: bool) -> None:  # noqa: FBT001
+        """Set whether the channels have languages to be translated to.
+
+        :param channel_ids: The ids of the channels
+        :param enabled: Whether the channels have languages to be translated to
+        """
+        if enabled:
+            self._channel_ids.update(channel_ids)
+        else:
+            self._channel_ids.difference_update(channel_ids)
+
+    def set_user(self, user_id: int, enabled: bool) -> None:  # noqa: FBT001
+        """Set whether the user has languages to be translated to.
+
+        :param user_id: The id of the user
+        :param enabled: Whether the user has languages to be translated to
+        """
+        if enabled:
+            self._user_ids.add(user_id)
+        else:
+            self._user_ids.discard(user_id)
+
+    def may_translate(self, message: Message) -> bool:
+        """Check if the message may need to be translated.
+
+        :param message: The message to check
+        :return: False if the message surely does not need to be translated
+        """
+        return (
+            not self._is_loaded
+            or message.channel.id in self._channel_ids
+            or message.author.id in self._user_ids
+        )
+
+
+translation_targets = TranslationTargets()
+
+
+@dataclass
+class _TranslationJob:
+    messages: list[Message]
+    dest_langs: list[Language]
+    src_lang: Language | None
+
+
+class TranslationQueue:
+    """Queues the messages to translate, limiting the number of translations running
+    at once per guild and in total.
+
+    Consecutive messages of the same author in the same channel that are still
+    waiting are merged into one translation. When a guild has too many waiting
+    translations, the oldest one is dropped, and when there are too many in total,
+    new ones are dropped.
+    """
+
+    GLOBAL_CONCURRENCY = 8
+    GUILD_CONCURRENCY = 2
+    MAX_PENDING = 100
+    MAX_PENDING_PER_GUILD = 10
+    MAX_MERGED_MESSAGES = 5
+
+    def __init__(self) -> None:
+        """Initialize the translation queue."""
+        self._logger = logging.getLogger(__name__)
+        self._semaphore = asyncio.Semaphore(self.GLOBAL_CONCURRENCY)
+        self._pending: dict[int | None, deque[_TranslationJob]] = {}
+        self._num_running: dict[int | None, int] = {}
+        self._num_pending = 0
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def num_pending(self) -> int:
+        """Get the number of translations waiting to be started."""
+        return self._num_pending
+
+    def submit(
+        self,
+        message: Message,
+        dest_langs: list[Language],
+        src_lang: Language | None = None,
+    ) -> None:
+        """Queue the message to be translated.
+
+        :param message: The message to translate
+        :param dest_langs: The languages to translate to
+        :param src_lang: The language of the message, or None to detect it
+        """
+        key = message.guild.id if message.guild is not None else None
+        queue = self._pending.setdefault(key, deque())
+
+        if len(queue) > 0:
+            last_job = queue[-1]
+            last_message = last_job.messages[-1]
+            if (
+                last_message.author == message.author
+                and last_message.channel == message.channel
+                and last_job.dest_langs == dest_langs
+                and last_job.src_lang == src_lang
+                and len(last_job.messages) < self.MAX_MERGED_MESSAGES
+            ):
+                last_job.messages.append(message)
+                return
+
+        if self._num_pending >= self.MAX_PENDING:
+            self._logger.warning(
+                "Dropped the translation of message %d: too many pending translations",
+                message.id,
+            )
+            return
+
+        if len(queue) >= self.MAX_PENDING_PER_GUILD:
+            dropped = queue.popleft()
+            self._num_pending -= 1
+            self._logger.warning(
+                "Dropped the translation of message %d: too many pending translations "
+                "in guild %s",
+                dropped.messages[0].id,
+                key,
+            )
+
+        queue.append(_TranslationJob([message], dest_langs, src_lang))
+        self._num_pending += 1
+        self._start(key)
+
+    def _start(self, key: int | None) -> None:
+        queue = self._pending.get(key)
+
+        while queue and self._num_running.get(key, 0) < self.GUILD_CONCURRENCY:
+            job = queue.popleft()
+            self._num_pending -= 1
+            self._num_running[key] = self._num_running.get(key, 0) + 1
+
+            task = asyncio.create_task(self._run(key, job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        if queue is not None and len(queue) == 0:
+            del self._pending[key]
+
+    async def _run(self, key: int | None, job: _TranslationJob) -> None:
+        try:
+            async with self._semaphore:
+                await _send_translation(job.messages, job.dest_langs, job.src_lang)
+        except Exception:
+            self._logger.exception(
+                "Failed to translate message %d", job.messages[-1].id
+            )
+        finally:
+            self._num_running[key] -= 1
+            if self._num_running[key] == 0:
+                del self._num_running[key]
+
+            self._start(key)
+
+
+translation_queue = TranslationQueue()
+
 _translator = get_translator()
+_detector = get_language_detector()
 
 
 def setup(bot: Bot) -> None:
     """Set up the translator commands."""
 
-    async def on_message(message: Message) -> None:
-        if len(message.content.strip()) == 0 or message.author == bot.user:
-            return
+    def needs_translation(message: Message) -> bool:
+        return (
+            message.author != bot.user
+            and not (message.content == "" or message.content.isspace())
+            and translation_targets.may_translate(message)
+        )
 
-        channel = await get_channel(message.channel.id)
+    async def on_message(message: Message) -> None:
+        channel = await get_channel(message.channel.id, ["translate_to", "locale"])
         src_lang = None
 
         if len(channel.translate_to) > 0:
             codes = channel.translate_to
             src_lang = Language(channel.locale) if channel.locale else None
         else:
-            user = await get_user(message.author.id)
+            user = await get_user(message.author.id, ["translate_to", "translate_in"])
             codes = (
                 user.translate_to
                 if len(user.translate_in) == 0
@@ -81,55 +280,79 @@ def setup(bot: Bot) -> None:
         if len(languages) == 0:
             return
 
-        await _send_translation(message, languages, src_lang)
+        translation_queue.submit(message, languages, src_lang)
 
-    bot.add_listener(on_message)
+    async def on_ready() -> None:
+        await translation_targets.load()
 
+    message_dispatcher.add_handler(needs_translation, on_message)
+    bot.add_listener(on_ready)
 
-async def _send_translation(  # noqa: C901
-    message: Message, dest_langs: Iterable[Language], src_lang: Language = None
-) -> None:
-    async with message.channel.typing():
-        text = message.content
-        if src_lang is None:
-            src_lang = Language((await asyncio.to_thread(langid.classify, text))[0])
 
-        if len(message.embeds) != 0:
-            text += "\n\n"
-            for embed in message.embeds:
-                if embed.description is not None:
-                    text += embed.description + "\n\n"
+def _get_text(message: Message) -> str:
+    text = message.content
+    if len(message.embeds) != 0:
+        text += "\n\n"
+        for embed in message.embeds:
+            if embed.description is not None:
+                text += embed.description + "\n\n"
+
+        text = text.removesuffix("\n\n")
 
-            text = text.removesuffix("\n\n")
+    return text
 
-        description = ""
-        async for translation in _translator.translate_targets(
-            text, dest_langs, src_lang
-        ):
-            if translation.source == translation.target:
-                continue
 
-            description += f"**__{translation.target.name}__**\n{translation.text}\n\n"
+async def _send_translation(  # noqa: C901
+    messages: Sequence[Message],
+    dest_langs: Iterable[Language],
+    src_lang: Language = None,
+) -> None:
+    # Reply to the latest message with the translation of all messages
+    message = messages[-1]
+    text = "\n".join(_get_text(msg) for msg in messages)
 
-        description.removesuffix("\n\n")
+    # Skip messages that only have URLs, mentions, emojis, code or numbers
+    masked = MaskedText(text)
+    if not masked.is_translatable():
+        return
 
-        if len(description) == 0:
-            return
+    if src_lang is None:
+        src_lang = await _detector.detect(masked.plain_text)
 
-        embeds = []
-        for chunk in _split(description, int(Limit.EMBED_DESCRIPTION_LEN)):
-            embed = Embed(color=templates.color, description=chunk)
-            embed.set_footer(
-                text=message.author.display_name,
-                icon_url=message.author.display_avatar.url,
-            )
-            embeds.append(embed)
+    # Skip translating when the message is already in every target language
+    dest_langs = [language for language in dest_langs if language != src_lang]
+    if len(dest_langs) == 0:
+        return
 
+    builder = _EmbedBuilder(message)
+    reply: Message | None = None
+    last_sent = 0.0
+
+    async with message.channel.typing():
         try:
-            await message.reply(
-                embeds=embeds[0 : min(len(embeds), int(Limit.NUM_EMBEDS_IN_MESSAGE))],
-                silent=True,
-            )
+            async for translation in _translator.translate_message(
+                text, dest_langs, src_lang
+            ):
+                if translation.source == translation.target:
+                    continue
+
+                builder.add(translation)
+
+                # Show the first translation as soon as possible and edit in the rest
+                if reply is None:
+                    reply = await message.reply(embeds=builder.embeds, silent=True)
+                    last_sent = time.monotonic()
+                    builder.is_dirty = False
+                elif time.monotonic() - last_sent >= EDIT_INTERVAL:
+                    await reply.edit(embeds=builder.embeds)
+                    last_sent = time.monotonic()
+                    builder.is_dirty = False
+
+                if builder.is_full:
+                    break
+
+            if reply is not None and builder.is_dirty:
+                await reply.edit(embeds=builder.embeds)
         except HTTPException as ex:
             if ex.code == ErrorCode.MESSAGE_TOO_LONG:
                 await message.reply(
@@ -143,9 +366,74 @@ async def _send_translation(  # noqa: C901
             raise
 
 
-def _split(string: str, count: int) -> Generator[str, Any, None]:
-    for i in range(0, len(string), count):
-        yield string[i : i + count]
+class _EmbedBuilder:
+    """Packs translations into embeds as they arrive, within the limits of Discord."""
+
+    def __init__(self, message: Message) -> None:
+        self._message = message
+        self._footer = message.author.display_name
+        self.embeds: list[Embed] = []
+        self.is_full = False
+        self.is_dirty = False
+        self._num_chars = 0
+
+    def _new_embed(self) -> Embed | None:
+        if len(self.embeds) >= int(
+            Limit.NUM_EMBEDS_IN_MESSAGE
+        ) or self._num_chars + len(self._footer) >= int(Limit.NUM_CHARACTERS_IN_EMBEDS):
+            self.is_full = True
+            return None
+
+        embed = Embed(color=templates.color, description="")
+        embed.set_footer(
+            text=self._footer, icon_url=self._message.author.display_avatar.url
+        )
+        self.embeds.append(embed)
+        self._num_chars += len(self._footer)
+        return embed
+
+    def _get_capacity(self, embed: Embed) -> int:
+        return min(
+            int(Limit.EMBED_DESCRIPTION_LEN) - len(embed.description),
+            int(Limit.NUM_CHARACTERS_IN_EMBEDS) - self._num_chars,
+        )
+
+    def add(self, translation: Translation) -> None:
+        """Add the translation to the embeds, splitting it if it does not fit."""
+        section = f"**__{translation.target.name}__**\n{translation.text}"
+
+        embed = self.embeds[-1] if len(self.embeds) > 0 else self._new_embed()
+        if embed is not None and len(embed.description) > 0:
+            # Keep the section in one embed if it fits in a new one
+            if self._get_capacity(embed) >= len(section) + 2:
+                section = "\n\n" + section
+            else:
+                embed = self._new_embed()
+
+        while embed is not None and len(section) > 0:
+            chunk = _get_chunk(section, self._get_capacity(embed))
+            embed.description += chunk
+            self._num_chars += len(chunk)
+            self.is_dirty = True
+
+            section = section[len(chunk) :].lstrip()
+            if len(section) > 0:
+                embed = self._new_embed()
+
+
+def _get_chunk(string: str, count: int) -> str:
+    """Get the longest prefix of the string within count characters, preferring to
+    end it at a line break, then at a space.
+    """
+    if len(string) <= count:
+        return string
+
+    for separator in ("\n", " "):
+        index = string.rfind(separator, 0, count)
+        if index > count // 2:
+            return string[:index]
+
+    return string[: max(0, count)]
 
 
 @command(translator_all_channels_description_default=str(ALL_CHANNELS_DEFAULT))
@@ -173,6 +461,7 @@ async def translator(
             [] if all_channels else [channel.id for channel in channel_select.values]
         )
         await set_user(user)
+        translation_targets.set_user(user.user_id, len(user.translate_to) > 0)
 
         await interaction.response.send_message(
             success(await loc.format_value_or_translate("translator-set")),
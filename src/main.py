@@ -1,10 +1,12 @@
 """Main script where the program starts."""
 
+import asyncio
 import logging
 import os
 import sys
 from importlib import import_module
 from logging.handlers import TimedRotatingFileHandler
+from typing import Any
 
 import discord
 import sentry_sdk
@@ -14,7 +16,9 @@ from discord.ext.commands import Bot
 from dotenv import load_dotenv
 
 from commands.movie import Movie
+from mongo import pool_metrics
 from utils.constants import ROOT_DIR, SRC_DIR
+from utils.dispatcher import message_dispatcher
 from utils.templates import forbidden
 from utils.translator import CommandTranslator, Localization
 
@@ -33,6 +37,8 @@ TEST_GUILD = (
 )
 IS_DEV_ENV = TEST_GUILD is not None
 
+POOL_METRICS_INTERVAL = float(os.getenv("MONGO_POOL_METRICS_INTERVAL") or 3600)
+
 sentry_sdk.init(
     dsn=os.environ["SENTRY_DSN"],
     environment="development" if IS_DEV_ENV else "production",
@@ -72,6 +78,7 @@ class SoruSora(Bot):
 
         self.help_command = None
         self._add_commands()
+        self._pool_metrics_task: asyncio.Task | None = None
 
         self.event(self.on_ready)
 
@@ -105,10 +112,23 @@ class SoruSora(Bot):
             # noinspection PyArgumentList
             self.tree.add_command(group_command_class(bot=self))  # ty: ignore[unknown-argument]
 
+    def dispatch(self, event_name: str, /, *args: Any, **kwargs: Any) -> None:  # noqa: ANN401
+        """Dispatch the event, running the message handlers only if they need it."""
+        super().dispatch(event_name, *args, **kwargs)
+
+        if event_name == "message":
+            for handler in message_dispatcher.get_handlers(args[0]):
+                self._schedule_event(handler, "on_message", *args, **kwargs)
+
     async def setup_hook(self) -> None:
         """Set up the SoruSora."""
         await self.tree.set_translator(CommandTranslator(self))
 
+        if POOL_METRICS_INTERVAL > 0:
+            self._pool_metrics_task = asyncio.create_task(
+                pool_metrics.log_periodically(POOL_METRICS_INTERVAL)
+            )
+
         if IS_DEV_ENV:
             self.tree.copy_global_to(guild=TEST_GUILD)
             synced_commands = [
@@ -2,40 +2,271 @@
 
 Instances:
     db
+    pool_metrics
 
 Classes:
-    Collection
+    Document
+    PoolMetrics
 
 Functions:
+    get_codec
     has_document
     get_document
+    get_documents
     set_document
+    update_document
+    update_documents
 """
 
+import asyncio
+import logging
 import os
-from collections.abc import Iterator
-from dataclasses import asdict, is_dataclass
-from typing import TypeVar
+import threading
+from collections.abc import Callable, Iterable, Iterator
+from dataclasses import fields, is_dataclass
+from functools import cache
+from typing import Any, TypeVar, get_args, get_origin, get_type_hints
 
 from motor.motor_asyncio import (
     AsyncIOMotorClient,
     AsyncIOMotorCollection,
     AsyncIOMotorDatabase,
 )
+from pymongo import UpdateOne
+from pymongo.monitoring import (
+    ConnectionCheckedInEvent,
+    ConnectionCheckedOutEvent,
+    ConnectionCheckOutFailedEvent,
+    ConnectionCheckOutStartedEvent,
+    ConnectionClosedEvent,
+    ConnectionCreatedEvent,
+    ConnectionPoolListener,
+    ConnectionReadyEvent,
+    PoolClearedEvent,
+    PoolClosedEvent,
+    PoolCreatedEvent,
+    PoolReadyEvent,
+)
 
 from utils.constants import DATABASE_NAME
 
-client = (
-    AsyncIOMotorClient(host="mongo") if os.getenv("DOCKER") else AsyncIOMotorClient()
+
+class PoolMetrics(ConnectionPoolListener):
+    """Collects the wait times of checking out connections from the pool, and logs
+    them periodically to size the pool to the real load.
+    """
+
+    def __init__(self) -> None:
+        """Initialize the pool metrics."""
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(__name__)
+        self.num_in_use = 0
+        self.reset()
+
+    def reset(self) -> None:
+        """Reset the collected metrics, except the number of connections in use."""
+        with self._lock:
+            self._reset()
+
+    def _reset(self) -> None:
+        self.num_checkouts = 0
+        self.num_failed_checkouts = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def log(self) -> None:
+        """Log the metrics collected since the last log, and reset them."""
+        with self._lock:
+            self._logger.info(
+                "Connection pool: %d checkouts, %d failed, %d in use, "
+                "wait time mean %.1fms and max %.1fms",
+                self.num_checkouts,
+                self.num_failed_checkouts,
+                self.num_in_use,
+                self.mean_wait_time * 1000,
+                self.max_wait_time * 1000,
+            )
+            self._reset()
+
+    async def log_periodically(self, interval: float) -> None:
+        """Log the metrics at the interval until cancelled.
+
+        :param interval: The seconds between the logs
+        """
+        while True:
+            await asyncio.sleep(interval)
+            self.log()
+
+    @property
+    def mean_wait_time(self) -> float:
+        """Get the mean wait time of the checkouts in seconds."""
+        num_checkouts = self.num_checkouts + self.num_failed_checkouts
+        return self.total_wait_time / num_checkouts if num_checkouts > 0 else 0.0
+
+    def _add_wait_time(self, duration: float | None) -> None:
+        if duration is None:
+            return
+
+        self.total_wait_time += duration
+        self.max_wait_time = max(self.max_wait_time, duration)
+
+    def connection_checked_out(self, event: ConnectionCheckedOutEvent) -> None:
+        """Record the wait time of the successful checkout."""
+        with self._lock:
+            self.num_checkouts += 1
+            self.num_in_use += 1
+            self._add_wait_time(event.duration)
+
+    def connection_check_out_failed(self, event: ConnectionCheckOutFailedEvent) -> None:
+        """Record the wait time of the failed checkout."""
+        with self._lock:
+            self.num_failed_checkouts += 1
+            self._add_wait_time(event.duration)
+
+    def connection_checked_in(self, _: ConnectionCheckedInEvent) -> None:
+        """Record that the connection is returned to the pool."""
+        with self._lock:
+            self.num_in_use = max(0, self.num_in_use - 1)
+
+    def pool_created(self, _: PoolCreatedEvent) -> None:
+        """Ignore the event."""
+
+    def pool_ready(self, _: PoolReadyEvent) -> None:
+        """Ignore the event."""
+
+    def pool_cleared(self, _: PoolClearedEvent) -> None:
+        """Ignore the event."""
+
+    def pool_closed(self, _: PoolClosedEvent) -> None:
+        """Ignore the event."""
+
+    def connection_created(self, _: ConnectionCreatedEvent) -> None:
+        """Ignore the event."""
+
+    def connection_ready(self, _: ConnectionReadyEvent) -> None:
+        """Ignore the event."""
+
+    def connection_closed(self, _: ConnectionClosedEvent) -> None:
+        """Ignore the event."""
+
+    def connection_check_out_started(self, _: ConnectionCheckOutStartedEvent) -> None:
+        """Ignore the event."""
+
+
+def _get_client_options() -> dict:
+    """Get the options of the client from the environment variables. The options
+    that are not set use the defaults of the driver.
+    """
+    env_to_option = {
+        "MONGO_MAX_POOL_SIZE": ("maxPoolSize", int),
+        "MONGO_MIN_POOL_SIZE": ("minPoolSize", int),
+        "MONGO_MAX_IDLE_TIME_MS": ("maxIdleTimeMS", int),
+        "MONGO_WAIT_QUEUE_TIMEOUT_MS": ("waitQueueTimeoutMS", int),
+        "MONGO_SERVER_SELECTION_TIMEOUT_MS": ("serverSelectionTimeoutMS", int),
+        "MONGO_CONNECT_TIMEOUT_MS": ("connectTimeoutMS", int),
+        "MONGO_SOCKET_TIMEOUT_MS": ("socketTimeoutMS", int),
+        "MONGO_COMPRESSORS": ("compressors", str),
+        "MONGO_READ_PREFERENCE": ("readPreference", str),
+    }
+
+    options = {}
+    for env, (option, convert) in env_to_option.items():
+        value = os.getenv(env)
+        if value:
+            options[option] = convert(value)
+
+    return options
+
+
+pool_metrics = PoolMetrics()
+
+client = AsyncIOMotorClient(
+    host="mongo" if os.getenv("DOCKER") else None,
+    event_listeners=[pool_metrics],
+    **_get_client_options(),
 )
 db: AsyncIOMotorDatabase = client.get_database(DATABASE_NAME)
 
 T = TypeVar("T", bound="Document")
 
 
+class _Codec:
+    """Converts instances of a dataclass from and to dictionaries. The fields and
+    the converters of nested dataclasses are resolved once per class.
+    """
+
+    def __init__(self, cls: type) -> None:
+        self._cls = cls
+        self._names = tuple(f.name for f in fields(cls))
+        self.names = frozenset(self._names)
+
+        self._encoders: list[tuple[str, Callable[[Any], Any]]] = []
+        self._decoders: list[tuple[str, Callable[[Any], Any]]] = []
+
+        hints = get_type_hints(cls)
+        for name in self._names:
+            hint = hints[name]
+            if is_dataclass(hint):
+                codec = get_codec(hint)
+                self._encoders.append((name, codec.encode))
+                self._decoders.append((name, codec.decode))
+            elif get_origin(hint) is list and is_dataclass(
+                item_hint := get_args(hint)[0]
+            ):
+                codec = get_codec(item_hint)
+                self._encoders.append((name, codec.encode_list))
+                self._decoders.append((name, codec.decode_list))
+
+    def encode(self, obj: object) -> dict:
+        """Convert the dataclass instance to a dictionary."""
+        result = {name: getattr(obj, name) for name in self._names}
+        for name, encoder in self._encoders:
+            result[name] = encoder(result[name])
+
+        return result
+
+    def encode_list(self, objs: Iterable[object]) -> list[dict]:
+        """Convert the dataclass instances to a list of dictionaries."""
+        if len(self._encoders) != 0:
+            return [self.encode(obj) for obj in objs]
+
+        # Fast path for flat dataclasses such as the messages of chat history
+        names = self._names
+        return [{name: getattr(obj, name) for name in names} for obj in objs]
+
+    def decode(self, source: dict) -> Any:  # noqa: ANN401
+        """Create a dataclass instance from the dictionary, ignoring unknown keys."""
+        kwargs = {key: value for key, value in source.items() if key in self.names}
+        for name, decoder in self._decoders:
+            if name in kwargs:
+                kwargs[name] = decoder(kwargs[name])
+
+        return self._cls(**kwargs)
+
+    def decode_list(self, sources: Iterable[dict]) -> list:
+        """Create dataclass instances from the dictionaries."""
+        if len(self._decoders) != 0:
+            return [self.decode(source) for source in sources]
+
+        # Fast path for flat dataclasses, whose stored keys always match the fields
+        cls = self._cls
+        return [cls(**source) for source in sources]
+
+
+@cache
+def get_codec(cls: type) -> _Codec:
+    """Get the codec of the dataclass
+    :param cls: The dataclass
+    :return: The codec.
+    """
+    return _Codec(cls)
+
+
 class Document:
     """A wrapper class to represent documents in the database."""
 
+    __slots__ = ()
+
     @staticmethod
     def _from_dict(child_class: type[T], source: dict) -> T:
         """Create a new document from the given source
@@ -43,26 +274,13 @@ class Document:
         :param source: The source to create a new user
         :return: The new document.
         """
-        # Only include keys that are actual attributes of the child class
-        valid_keys = set(child_class.__annotations__.keys())
-        filtered_source = {k: v for k, v in source.items() if k in valid_keys}
-
-        return child_class(**filtered_source)
+        return get_codec(child_class).decode(source)
 
     def to_dict(self) -> dict:
         """Convert this document to dictionary
         :return: The dictionary.
         """
-        result = {}
-        for key, value in self.__dict__.items():
-            if isinstance(value, list):
-                result[key] = [asdict(v) if is_dataclass(v) else v for v in value]
-            elif is_dataclass(value):
-                result[key] = asdict(value)
-            else:
-                result[key] = value
-
-        return result
+        return get_codec(type(self)).encode(self)
 
 
 async def has_document(collection: AsyncIOMotorCollection, doc_filter: dict) -> bool:
@@ -74,26 +292,41 @@ async def has_document(collection: AsyncIOMotorCollection, doc_filter: dict) ->
     return await collection.count_documents(doc_filter) > 0
 
 
+def _get_projection(fields: Iterable[str] | None) -> dict | None:
+    if fields is None:
+        return None
+
+    return {"_id": 0} | dict.fromkeys(fields, 1)
+
+
 async def get_document(
-    collection: AsyncIOMotorCollection, doc_filter: dict
+    collection: AsyncIOMotorCollection,
+    doc_filter: dict,
+    fields: Iterable[str] | None = None,
 ) -> dict | None:
     """Get the document from the collection
     :param collection: The target collection
     :param doc_filter: The filter to get
+    :param fields: The fields to fetch, or None to fetch the whole document
     :return: The document, or None if it does not exist.
     """
-    return await collection.find_one(doc_filter)
+    return await collection.find_one(doc_filter, _get_projection(fields))
 
 
 async def get_documents(
-    collection: AsyncIOMotorCollection, doc_filter: dict
+    collection: AsyncIOMotorCollection,
+    doc_filter: dict,
+    fields: Iterable[str] | None = None,
 ) -> Iterator[dict]:
     """Get the documents from the collection
     :param collection: The target collection
     :param doc_filter: The filter to get
+    :param fields: The fields to fetch, or None to fetch the whole documents
     :return: The documents.
     """
-    return await collection.find(doc_filter).to_list(length=None)
+    return await collection.find(doc_filter, _get_projection(fields)).to_list(
+        length=None
+    )
 
 
 async def set_document(
@@ -106,3 +339,32 @@ async def set_document(
     :param doc: The document to set.
     """
     await collection.update_one(doc_filter, {"$set": doc}, upsert=True)
+
+
+async def update_document(
+    collection: AsyncIOMotorCollection, doc_filter: dict, update: dict | list[dict]
+) -> None:
+    """Apply the update operators to the document in the collection. If the document
+    does not exist, it will be created.
+    :param collection: The target collection
+    :param doc_filter: The filter to update
+    :param update: The update operators, or the aggregation pipeline to apply.
+    """
+    await collection.update_one(doc_filter, update, upsert=True)
+
+
+async def update_documents(
+    collection: AsyncIOMotorCollection, updates: Iterable[tuple[dict, dict]]
+) -> None:
+    """Apply the update operators to the documents in the collection in a single
+    round-trip. If a document does not exist, it will be created.
+    :param collection: The target collection
+    :param updates: The pairs of the filter and the update operators to apply.
+    """
+    operations = [
+        UpdateOne(doc_filter, update, upsert=True) for doc_filter, update in updates
+    ]
+    if len(operations) == 0:
+        return
+
+    await collection.bulk_write(operations, ordered=False)
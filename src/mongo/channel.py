@@ -6,19 +6,31 @@ Classes:
 Functions:
     has_channel
     get_channel
+    get_channels
+    get_translated_channel_ids
     set_channel
+    update_channels
 """
 
+from collections.abc import Iterable
 from dataclasses import dataclass, field
 
 from motor.motor_asyncio import AsyncIOMotorCollection
 
-from mongo import Document, db, get_document, get_documents, has_document, set_document
+from mongo import (
+    Document,
+    db,
+    get_document,
+    get_documents,
+    has_document,
+    set_document,
+    update_documents,
+)
 
 collection: AsyncIOMotorCollection = db.get_collection("channel")
 
 
-@dataclass
+@dataclass(slots=True)
 class Channel(Document):
     """A wrapper class to represent channel configs in the database."""
 
@@ -47,33 +59,67 @@ async def has_channel(channel_id: int) -> bool:
     return await has_document(collection, _get_filter(channel_id))
 
 
-async def get_channel(channel_id: int) -> Channel:
+def _get_fields(fields: Iterable[str] | None) -> list[str] | None:
+    return None if fields is None else ["channel_id", *fields]
+
+
+async def get_channel(channel_id: int, fields: Iterable[str] | None = None) -> Channel:
     """Get the channel from the database
     :param channel_id: The channel id to get
+    :param fields: The fields to load, or None to load all of them. The other fields
+    keep their default values, so a partially loaded channel must not be passed to
+    set_channel
     :return: The channel.
     """
-    doc = await get_document(collection, _get_filter(channel_id))
+    doc = await get_document(collection, _get_filter(channel_id), _get_fields(fields))
     if doc is None:
         return Channel(channel_id=channel_id)
 
     return Channel.from_dict(doc)
 
 
-async def get_channels(channel_ids: list[int]) -> list[Channel]:
+async def get_channels(
+    channel_ids: list[int], fields: Iterable[str] | None = None
+) -> list[Channel]:
     """Get the channels from the database
     :param channel_ids: The channel ids to get
+    :param fields: The fields to load, or None to load all of them
     :return: The channels.
     """
     return [
         Channel.from_dict(channel)
         for channel in await get_documents(
-            collection, {"channel_id": {"$in": channel_ids}}
+            collection, {"channel_id": {"$in": channel_ids}}, _get_fields(fields)
         )
     ]
 
 
+async def get_translated_channel_ids() -> set[int]:
+    """Get the ids of the channels that have languages to be translated to
+    :return: The channel ids.
+    """
+    return {
+        doc["channel_id"]
+        for doc in await get_documents(
+            collection, {"translate_to.0": {"$exists": True}}, ["channel_id"]
+        )
+    }
+
+
 async def set_channel(channel: Channel) -> None:
     """Set the channel to the database
     :param channel: The channel to set.
     """
     await set_document(collection, _get_filter(channel.channel_id), channel.to_dict())
+
+
+async def update_channels(channel_ids: Iterable[int], values: dict) -> None:
+    """Set the same values to the channels in the database in a single round-trip.
+    The channels that are not present will be created
+    :param channel_ids: The channel ids to update
+    :param values: The field names and their new values.
+    """
+    await update_documents(
+        collection,
+        ((_get_filter(channel_id), {"$set": values}) for channel_id in channel_ids),
+    )
@@ -1,31 +1,64 @@
 """Provides functions for chat collection.
 
 Classes:
+    Attachment
+    Message
     Chat
+    ChatSession
 
 Functions:
     get_chat
-    set_chat
+    set_token
+    get_history_owner
+    get_history_length
+    get_attachment_digests
+    remove_attachments
+    extend_history
+    clear_history
 """
 
+from collections.abc import Iterable
 from dataclasses import dataclass, field
+from types import TracebackType
+from typing import Self
 
 from motor.motor_asyncio import AsyncIOMotorCollection
 
-from mongo import Document, db, get_document, set_document
+from mongo import Document, db, get_codec, get_document, update_document
+from utils.attachments import attachment_store
 
 collection: AsyncIOMotorCollection = db.get_collection("chat")
 
+MAX_HISTORY_LEN = 1000
+"""
+Maximum number of messages kept in the chat history
+"""
+
+
+@dataclass(slots=True)
+class Attachment:
+    """A data class that has information to load an attachment from the store."""
+
+    digest: str
+    mime_type: str
 
-@dataclass
+
+@dataclass(slots=True)
 class Message:
-    """A data class that has information to retrieve a message."""
+    """A data class that has information to retrieve a message. The content is
+    stored along with it, so the message does not need to be fetched from Discord.
+    The content is None for the messages stored before.
+    """
 
     message_id: int
     channel_id: int
+    num_tokens: int | None = field(default=None, compare=False)
+    role: str | None = field(default=None, compare=False)
+    text: str | None = field(default=None, compare=False)
+    attachments: list[Attachment] = field(default_factory=list, compare=False)
 
 
-@dataclass
+@dataclass(slots=True)
 class Chat(Document):
     """A wrapper class to represent chat in the database."""
 
@@ -46,23 +79,347 @@ def _get_filter(user_id: int) -> dict:
     return {"user_id": user_id}
 
 
-async def get_chat(user_id: int) -> Chat:
+async def get_chat(user_id: int, fields: Iterable[str] | None = None) -> Chat:
     """Get the chat of the user from the database.
 
     :param user_id: The user id to get the chat
+    :param fields: The fields to load, or None to load all of them. The other fields
+    keep their default values
     """
-    doc = await get_document(collection, _get_filter(user_id))
+    doc = await get_document(
+        collection,
+        _get_filter(user_id),
+        None if fields is None else ["user_id", *fields],
+    )
     if doc is None:
         return Chat(user_id=user_id)
 
-    doc["history"] = [Message(**message) for message in doc["history"]]
-
     return Chat.from_dict(doc)
 
 
-async def set_chat(chat: Chat) -> None:
-    """Set the chat of the user in the database.
+async def set_token(user_id: int, token: bytes | None) -> None:
+    """Set the encrypted token of the user in the database.
+
+    :param user_id: The user id to set the token
+    :param token: The encrypted token, or None to remove it
+    """
+    await update_document(collection, _get_filter(user_id), {"$set": {"token": token}})
+
+
+_has_indexes = False
+
+
+async def _create_indexes() -> None:
+    global _has_indexes  # noqa: PLW0603
+    if not _has_indexes:
+        # Creating an existing index is a no-op, so it only needs to be done once
+        await collection.create_index("history.message_id")
+        await collection.create_index("history.attachments.digest")
+        _has_indexes = True
+
+
+async def get_history_owner(channel_id: int, message_id: int) -> int | None:
+    """Get the user whose chat history has the message.
+
+    :param channel_id: The channel id of the message
+    :param message_id: The message id to find
+    :return: The user id, or None if no chat history has the message
+    """
+    await _create_indexes()
+
+    doc = await get_document(
+        collection,
+        {
+            "history": {
+                "$elemMatch": {"message_id": message_id, "channel_id": channel_id}
+            }
+        },
+        ["user_id"],
+    )
+    return None if doc is None else doc["user_id"]
+
+
+async def get_history_length(user_id: int) -> int:
+    """Get the number of messages in the chat history of the user, without loading
+    the messages.
+
+    :param user_id: The user id to get the length of the chat history
+    :return: The number of messages
+    """
+    docs = await collection.aggregate(
+        [
+            {"$match": _get_filter(user_id)},
+            {
+                "$project": {
+                    "_id": 0,
+                    "length": {"$size": {"$ifNull": ["$history", []]}},
+                }
+            },
+        ]
+    ).to_list(length=1)
+    return docs[0]["length"] if len(docs) > 0 else 0
+
+
+async def get_attachment_digests(user_id: int) -> list[str]:
+    """Get the digests of the attachments in the chat history of the user.
 
-    :param chat: The chat to set
+    :param user_id: The user id to get the digests
+    :return: The digests
     """
-    await set_document(collection, _get_filter(chat.user_id), chat.to_dict())
+    doc = await get_document(
+        collection, _get_filter(user_id), ["history.attachments.digest"]
+    )
+    if doc is None:
+        return []
+
+    return [
+        attachment["digest"]
+        for message in doc.get("history", [])
+        for attachment in message.get("attachments", [])
+    ]
+
+
+async def remove_attachments(digests: Iterable[str]) -> None:
+    """Remove the stored attachments that no chat history refers to anymore. The
+    attachments are shared by the histories that have the same contents.
+
+    :param digests: The digests of the attachments of the removed messages
+    """
+    digests = set(digests)
+    if len(digests) == 0:
+        return
+
+    await _create_indexes()
+    referenced = await collection.distinct(
+        "history.attachments.digest",
+        {"history.attachments.digest": {"$in": list(digests)}},
+    )
+
+    await attachment_store.remove(digests.difference(referenced))
+
+
+async def extend_history(user_id: int, messages: Iterable[Message]) -> None:
+    """Append the messages to the chat history of the user in the database.
+    Only the latest MAX_HISTORY_LEN messages are kept.
+
+    :param user_id: The user id to extend the chat history
+    :param messages: The messages to append
+    """
+    await update_document(
+        collection,
+        _get_filter(user_id),
+        {
+            "$push": {
+                "history": {
+                    "$each": get_codec(Message).encode_list(messages),
+                    "$slice": -MAX_HISTORY_LEN,
+                }
+            }
+        },
+    )
+
+
+async def clear_history(user_id: int) -> None:
+    """Remove all messages from the chat history of the user in the database, along
+    with their attachments.
+
+    :param user_id: The user id to clear the chat history
+    """
+    digests = await get_attachment_digests(user_id)
+    await update_document(collection, _get_filter(user_id), {"$set": {"history": []}})
+    await remove_attachments(digests)
+
+
+class ChatSession:
+    """Loads the chat of a user once and writes the changes made to its history
+    during a chat turn in a single update.
+
+    The chat is loaded when entering the context and the changes are written when
+    leaving it, unless an exception is raised.
+    """
+
+    def __init__(self, user_id: int) -> None:
+        """Create a chat session.
+
+        :param user_id: The user id of the chat
+        """
+        self._user_id = user_id
+        self._chat = Chat(user_id=user_id)
+
+        # The history is the slice [start:end] of the loaded history plus appended
+        self._loaded: list[Message] = []
+        self._start = 0
+        self._end = 0
+        self._appended: list[Message] = []
+        self._removed: list[Message] = []
+
+    async def __aenter__(self) -> Self:
+        """Load the chat of the user."""
+        self._chat = await get_chat(self._user_id, ["history", "token"])
+        self._loaded = self._chat.history.copy()
+        self._end = len(self._loaded)
+        return self
+
+    async def __aexit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        """Write the changes to the database."""
+        if exc_type is None:
+            await self.flush()
+
+    @property
+    def chat(self) -> Chat:
+        """Get the chat. Its history reflects the changes made in this session."""
+        return self._chat
+
+    def extend_history(self, messages: Iterable[Message]) -> None:
+        """Append the messages to the chat history. Only the latest MAX_HISTORY_LEN
+        messages are kept.
+
+        :param messages: The messages to append
+        """
+        messages = list(messages)
+        self._chat.history.extend(messages)
+        self._appended.extend(messages)
+        self.trim_history(MAX_HISTORY_LEN)
+
+    def truncate_history(self, index: int) -> None:
+        """Remove the messages from the given index to the end of the chat history.
+
+        :param index: The index of the first message to remove
+        """
+        index = max(0, index)
+        self._removed.extend(self._chat.history[index:])
+        del self._chat.history[index:]
+
+        num_kept = self._end - self._start
+        if index <= num_kept:
+            self._end = self._start + index
+            self._appended.clear()
+        else:
+            del self._appended[index - num_kept :]
+
+    def trim_history(self, length: int) -> None:
+        """Remove the oldest messages from the chat history until only the given
+        number of latest messages remain.
+
+        :param length: The number of latest messages to keep
+        """
+        num_removed = len(self._chat.history) - max(0, length)
+        if num_removed <= 0:
+            return
+
+        self._removed.extend(self._chat.history[:num_removed])
+        del self._chat.history[:num_removed]
+
+        num_kept = self._end - self._start
+        if num_removed <= num_kept:
+            self._start += num_removed
+        else:
+            self._start = self._end
+            del self._appended[: num_removed - num_kept]
+
+    def clear_history(self) -> None:
+        """Remove all messages from the chat history."""
+        self.truncate_history(0)
+
+    def _get_kept(self) -> dict:
+        """Get the expression of the loaded messages that are kept in the stored
+        history. The removed ones are found by their ids rather than their positions
+        when loaded, as concurrent sessions may have changed the history since.
+        """
+
+        def index_of(message: Message) -> dict:
+            return {"$indexOfArray": ["$$history.message_id", message.message_id]}
+
+        # The messages stored before the last trimmed message are trimmed as well
+        start = (
+            {"$add": [index_of(self._loaded[self._start - 1]), 1]}
+            if self._start > 0
+            else 0
+        )
+
+        # The messages stored after the first truncated message are truncated as well,
+        # unless it is already removed
+        end = (
+            {
+                "$let": {
+                    "vars": {"index": index_of(self._loaded[self._end])},
+                    "in": {
+                        "$cond": [
+                            {"$lt": ["$$index", 0]},
+                            {"$size": "$$history"},
+                            "$$index",
+                        ]
+                    },
+                }
+            }
+            if self._end < len(self._loaded)
+            else {"$size": "$$history"}
+        )
+
+        return {
+            "$let": {
+                "vars": {"history": {"$ifNull": ["$history", []]}},
+                "in": {
+                    "$let": {
+                        "vars": {"start": start, "end": end},
+                        "in": {
+                            "$slice": [
+                                {"$slice": ["$$history", "$$end"]},
+                                "$$start",
+                                {"$max": [1, "$$end"]},
+                            ]
+                        },
+                    }
+                },
+            }
+        }
+
+    async def flush(self) -> None:
+        """Write the changes made to the chat history to the database."""
+        is_kept = self._start == 0 and self._end == len(self._loaded)
+        if is_kept:
+            if len(self._appended) > 0:
+                # A push keeps the messages appended concurrently
+                await extend_history(self._user_id, self._appended)
+        else:
+            appended = get_codec(Message).encode_list(self._appended)
+
+            await update_document(
+                collection,
+                _get_filter(self._user_id),
+                [
+                    {
+                        "$set": {
+                            "history": {
+                                "$slice": [
+                                    {
+                                        "$concatArrays": [
+                                            self._get_kept(),
+                                            {"$literal": appended},
+                                        ]
+                                    },
+                                    -MAX_HISTORY_LEN,
+                                ]
+                            }
+                        }
+                    }
+                ],
+            )
+
+        self._loaded = self._chat.history.copy()
+        self._start = 0
+        self._end = len(self._loaded)
+        self._appended.clear()
+
+        # The attachments are removed only after the messages referring to them
+        removed, self._removed = self._removed, []
+        await remove_attachments(
+            attachment.digest
+            for message in removed
+            for attachment in message.attachments
+        )
@@ -6,19 +6,28 @@ Classes:
 Functions:
     has_user
     get_user
+    get_translating_user_ids
     set_user
 """
 
+from collections.abc import Iterable
 from dataclasses import dataclass, field
 
 from motor.motor_asyncio import AsyncIOMotorCollection
 
-from mongo import Document, db, get_document, has_document, set_document
+from mongo import (
+    Document,
+    db,
+    get_document,
+    get_documents,
+    has_document,
+    set_document,
+)
 
 collection: AsyncIOMotorCollection = db.get_collection("user")
 
 
-@dataclass
+@dataclass(slots=True)
 class User(Document):
     """A wrapper class to represent user in the database."""
 
@@ -48,18 +57,37 @@ async def has_user(user_id: int) -> bool:
     return await has_document(collection, _get_filter(user_id))
 
 
-async def get_user(user_id: int) -> User:
+async def get_user(user_id: int, fields: Iterable[str] | None = None) -> User:
     """Get the user from the database
     :param user_id: The user id to get
+    :param fields: The fields to load, or None to load all of them. The other fields
+    keep their default values, so a partially loaded user must not be passed to
+    set_user
     :return: The user.
     """
-    doc = await get_document(collection, _get_filter(user_id))
+    doc = await get_document(
+        collection,
+        _get_filter(user_id),
+        None if fields is None else ["user_id", *fields],
+    )
     if doc is None:
         return User(user_id=user_id)
 
     return User.from_dict(doc)
 
 
+async def get_translating_user_ids() -> set[int]:
+    """Get the ids of the users that have languages to be translated to
+    :return: The user ids.
+    """
+    return {
+        doc["user_id"]
+        for doc in await get_documents(
+            collection, {"translate_to.0": {"$exists": True}}, ["user_id"]
+        )
+    }
+
+
 async def set_user(user: User) -> None:
     """Update the user in the database. If the user is not present, create a new user
     :param user: The user to update.
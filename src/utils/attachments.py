@@ -0,0 +1,141 @@
+"""Provides a size-bounded store of attachments on disk.
+
+Classes:
+    AttachmentStore
+
+Instances:
+    attachment_store
+"""
+
+import asyncio
+import contextlib
+import hashlib
+import os
+from collections import OrderedDict
+from collections.abc import Iterable
+from pathlib import Path
+
+import aiofiles
+
+from utils.constants import CACHE_DIR
+
+
+class AttachmentStore:
+    """Keeps the attachments by the digests of their contents, evicting the least
+    recently used ones when the total size exceeds the limit.
+    """
+
+    MAX_SIZE = 256 * 1024 * 1024
+
+    def __init__(
+        self, path: Path = CACHE_DIR / "attachments", max_size: int = MAX_SIZE
+    ) -> None:
+        """Initialize the attachment store.
+
+        :param path: The directory to store the attachments in
+        :param max_size: The maximum total size of the attachments in bytes
+        """
+        self._path = path
+        self._max_size = max_size
+        self._lock = asyncio.Lock()
+
+        # Sizes of the stored attachments, from the least recently used one
+        self._sizes: OrderedDict[str, int] | None = None
+        self._total_size = 0
+
+    def _scan(self) -> OrderedDict[str, int]:
+        self._path.mkdir(parents=True, exist_ok=True)
+
+        stats = [
+            (path.name, path.stat())
+            for path in self._path.iterdir()
+            if path.is_file() and path.suffix == ""
+        ]
+        stats.sort(key=lambda item: item[1].st_mtime)
+
+        return OrderedDict((name, stat.st_size) for name, stat in stats)
+
+    async def _get_sizes(self) -> OrderedDict[str, int]:
+        if self._sizes is None:
+            self._sizes = await asyncio.to_thread(self._scan)
+            self._total_size = sum(self._sizes.values())
+
+        return self._sizes
+
+    async def _evict(self) -> None:
+        sizes = await self._get_sizes()
+        while self._total_size > self._max_size and len(sizes) > 0:
+            digest, size = sizes.popitem(last=False)
+            self._total_size -= size
+            await asyncio.to_thread((self._path / digest).unlink, missing_ok=True)
+
+    async def put(self, data: bytes) -> str:
+        """Store the attachment.
+
+        :param data: The contents of the attachment
+        :return: The digest to load the attachment with
+        """
+        digest = hashlib.sha256(data).hexdigest()
+
+        async with self._lock:
+            sizes = await self._get_sizes()
+            if digest in sizes:
+                sizes.move_to_end(digest)
+                return digest
+
+            path = self._path / digest
+            temp_path = path.with_suffix(".tmp")
+            async with aiofiles.open(temp_path, "wb") as file:
+                await file.write(data)
+
+            await asyncio.to_thread(temp_path.replace, path)
+
+            sizes[digest] = len(data)
+            self._total_size += len(data)
+            await self._evict()
+
+        return digest
+
+    async def get(self, digest: str) -> bytes | None:
+        """Load the attachment.
+
+        :param digest: The digest returned when the attachment was stored
+        :return: The contents of the attachment, or None if it was evicted
+        """
+        async with self._lock:
+            sizes = await self._get_sizes()
+            if digest not in sizes:
+                return None
+
+            sizes.move_to_end(digest)
+
+        path = self._path / digest
+        try:
+            async with aiofiles.open(path, "rb") as file:
+                data = await file.read()
+        except FileNotFoundError:
+            return None
+
+        # Keep the order of use across restarts
+        with contextlib.suppress(FileNotFoundError):
+            await asyncio.to_thread(os.utime, path)
+
+        return data
+
+    async def remove(self, digests: Iterable[str]) -> None:
+        """Remove the attachments, such as when their chat history is cleared.
+
+        :param digests: The digests of the attachments to remove
+        """
+        async with self._lock:
+            sizes = await self._get_sizes()
+            for digest in set(digests):
+                size = sizes.pop(digest, None)
+                if size is None:
+                    continue
+
+                self._total_size -= size
+                await asyncio.to_thread((self._path / digest).unlink, missing_ok=True)
+
+
+attachment_store = AttachmentStore()
@@ -48,6 +48,7 @@ class Limit(Enum):
     """Provides limits from discord API."""
 
     EMBED_DESCRIPTION_LEN = 4096
+    NUM_CHARACTERS_IN_EMBEDS = 6000
     COMMAND_NAME_LEN = 32
     COMMAND_DESCRIPTION_LEN = 100
     NUM_CHARACTERS_IN_MESSAGE = 2000
@@ -0,0 +1,48 @@
+"""Provides a dispatcher that filters messages before running their handlers.
+
+Classes:
+    MessageDispatcher
+
+Instances:
+    message_dispatcher
+"""
+
+from collections.abc import Callable, Coroutine, Generator
+from typing import Any
+
+from discord import Message
+
+Predicate = Callable[[Message], bool]
+Handler = Callable[[Message], Coroutine[Any, Any, None]]
+
+
+class MessageDispatcher:
+    """Runs cheap synchronous predicates on every message, so that coroutines are
+    only scheduled for the handlers that need the message.
+    """
+
+    def __init__(self) -> None:
+        """Initialize the message dispatcher."""
+        self._handlers: list[tuple[Predicate, Handler]] = []
+
+    def add_handler(self, predicate: Predicate, handler: Handler) -> None:
+        """Add the handler to be run for the messages accepted by the predicate.
+
+        :param predicate: The function that checks if the message needs the handler.
+        It must not block, as it runs for every message
+        :param handler: The coroutine function to handle the message
+        """
+        self._handlers.append((predicate, handler))
+
+    def get_handlers(self, message: Message) -> Generator[Handler, Any, None]:
+        """Get the handlers that need the message.
+
+        :param message: The message to dispatch
+        :return: The handlers whose predicates accept the message
+        """
+        for predicate, handler in self._handlers:
+            if predicate(message):
+                yield handler
+
+
+message_dispatcher = MessageDispatcher()
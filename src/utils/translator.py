@@ -3,6 +3,8 @@
 Classes:
     Language
     Translation
+    MaskedText
+    LanguageDetector
     Localization
     CommandTranslator
     BaseTranslator
@@ -12,6 +14,7 @@ Classes:
 Functions:
     get_resource
     get_translator
+    get_language_detector
 """
 
 import asyncio
@@ -19,8 +22,11 @@ import contextlib
 import itertools
 import json
 import logging
+import re
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 from collections.abc import AsyncGenerator, Generator, Iterable
+from functools import cache
 from os import PathLike
 from pathlib import Path
 from typing import Any, ClassVar
@@ -30,6 +36,8 @@ import argostranslate.package
 import argostranslate.translate
 import babel
 import discord
+import langid.langid
+import numpy as np
 from deep_translator import GoogleTranslator as Google
 from deep_translator.exceptions import TranslationNotFound
 from discord import AppCommandType, Locale, app_commands
@@ -155,6 +163,206 @@ class Translation:
         return self._translated_text
 
 
+class MaskedText:
+    """Replaces the spans of a text to keep as they are, such as URLs, mentions,
+    emojis, timestamps and code, with numbered placeholders, so that the rest of the
+    text can be translated as a whole and the spans restored afterwards.
+    """
+
+    _PATTERN = re.compile(
+        r"```.*?```"  # Code blocks
+        r"|`[^`]+`"  # Inline code
+        r"|<?https?://\S+>?"  # URLs
+        r"|<a?:\w+:\d+>"  # Custom emojis
+        r"|<(?:@[!&]?|#)\d+>"  # User, role and channel mentions
+        r"|<t:-?\d+(?::[tTdDfFR])?>"  # Timestamps
+        r"|@(?:everyone|here)\b"
+        r"|\{\d+\}",  # Text that would be taken for a placeholder
+        re.DOTALL,
+    )
+
+    # Translators may add spaces inside the placeholders
+    _PLACEHOLDER_PATTERN = re.compile(r"\{\s*(\d+)\s*\}")
+
+    def __init__(self, text: str) -> None:
+        """Mask the text.
+
+        :param text: The text to mask
+        """
+        self._spans: list[str] = []
+
+        def mask(match: re.Match[str]) -> str:
+            self._spans.append(match.group())
+            return f"{{{len(self._spans) - 1}}}"
+
+        masked = self._PATTERN.sub(mask, text)
+
+        # Keep the whitespaces around the text, as translators strip them
+        self._text = masked.strip()
+        start = masked.index(self._text)
+        self._prefix = masked[:start]
+        self._suffix = masked[start + len(self._text) :]
+
+        self._plain_text = " ".join(
+            segment.strip()
+            for segment in self._PATTERN.split(text)
+            if not segment.isspace()
+        ).strip()
+
+    def is_translatable(self) -> bool:
+        """Check if the text has anything to translate.
+
+        :return: True if the text has any letters outside the masked spans
+        """
+        return any(char.isalpha() for char in self._plain_text)
+
+    @property
+    def text(self) -> str:
+        """Get the text to translate, with the spans replaced by placeholders."""
+        return self._text
+
+    @property
+    def plain_text(self) -> str:
+        """Get the text without the masked spans, such as to detect its language."""
+        return self._plain_text
+
+    def unmask(self, translation: str) -> str:
+        """Restore the masked spans in the translation of the text.
+
+        :param translation: The translation of the text with the placeholders
+        :return: The translated text
+        """
+        restored: set[int] = set()
+
+        def restore(match: re.Match[str]) -> str:
+            index = int(match.group(1))
+            if index >= len(self._spans):
+                return match.group()
+
+            restored.add(index)
+            return self._spans[index]
+
+        text = self._PLACEHOLDER_PATTERN.sub(restore, translation)
+
+        # Keep the spans even if the translator dropped their placeholders
+        dropped = [span for i, span in enumerate(self._spans) if i not in restored]
+
+        return self._prefix + " ".join([text, *dropped]) + self._suffix
+
+
+class LanguageDetector:
+    """Detects the languages of texts with langid.
+
+    The requests made in the same iteration of the event loop are classified
+    together in a single vectorized pass, and the results for short texts are
+    memoized.
+    """
+
+    MEMO_TEXT_LEN = 64
+    """
+    Maximum length of the texts whose results are memoized
+    """
+
+    MEMO_SIZE = 4096
+    """
+    Maximum number of the memoized results
+    """
+
+    INLINE_BATCH_SIZE = 4
+    """
+    Maximum number of the texts in a batch classified on the event loop instead of a
+    thread, as a small batch takes about a millisecond
+    """
+
+    INLINE_TEXT_LEN = 1024
+    """
+    Maximum total length of the texts in a batch classified on the event loop
+    """
+
+    def __init__(self, languages: Iterable[Language] | None = None) -> None:
+        """Initialize the language detector and load the model.
+
+        :param languages: The languages to choose from, or None to choose from all
+        languages known to langid. Restricting them makes the detection faster and
+        avoids detecting languages that cannot be translated anyway
+        """
+        # Only the most likely language is needed, so skip normalizing the scores
+        self._identifier = langid.langid.LanguageIdentifier.from_modelstring(
+            langid.langid.model, norm_probs=False
+        )
+
+        if languages is not None:
+            codes = {language.trim_territory().code for language in languages}
+            known_codes = [
+                code for code in self._identifier.nb_classes if code in codes
+            ]
+            if len(known_codes) > 0:
+                self._identifier.set_languages(known_codes)
+        self._memo: OrderedDict[str, Language] = OrderedDict()
+        self._pending: list[tuple[str, asyncio.Future[Language]]] = []
+        self._tasks: set[asyncio.Task] = set()
+
+    async def detect(self, text: str) -> Language:
+        """Detect the language of the text.
+
+        :param text: The text to detect the language of
+        :return: The most likely language of the text
+        """
+        if text in self._memo:
+            self._memo.move_to_end(text)
+            return self._memo[text]
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if len(self._pending) == 0:
+            loop.call_soon(self._flush)
+
+        self._pending.append((text, future))
+        return await future
+
+    def _flush(self) -> None:
+        batch, self._pending = self._pending, []
+
+        task = asyncio.create_task(self._detect_batch(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _detect_batch(
+        self, batch: list[tuple[str, asyncio.Future[Language]]]
+    ) -> None:
+        texts = [text for text, _ in batch]
+        try:
+            if (
+                len(texts) <= self.INLINE_BATCH_SIZE
+                and sum(map(len, texts)) <= self.INLINE_TEXT_LEN
+            ):
+                codes = self._classify(texts)
+            else:
+                codes = await asyncio.to_thread(self._classify, texts)
+            results = [Language(code) for code in codes]
+        except Exception as ex:  # noqa: BLE001
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(ex)
+            return
+
+        for (text, future), language in zip(batch, results, strict=True):
+            if len(text) <= self.MEMO_TEXT_LEN:
+                self._memo[text] = language
+                if len(self._memo) > self.MEMO_SIZE:
+                    self._memo.popitem(last=False)
+
+            if not future.done():
+                future.set_result(language)
+
+    def _classify(self, texts: list[str]) -> list[str]:
+        identifier = self._identifier
+        features = np.stack([identifier.instance2fv(text) for text in texts])
+        scores = features @ identifier.nb_ptc + identifier.nb_pc
+
+        return [identifier.nb_classes[index] for index in scores.argmax(axis=1)]
+
+
 class BaseTranslator(ABC):
     """Abstract base class for translators."""
 
@@ -232,6 +440,30 @@ class BaseTranslator(ABC):
         for target in targets:
             yield await self.translate(text, target, source)
 
+    async def translate_message(
+        self,
+        text: str,
+        targets: Iterable[Language],
+        source: Language = DEFAULT_LANGUAGE,
+    ) -> AsyncGenerator[Translation, Any]:
+        """Translate the message to the target languages in a single request per
+        language, keeping URLs, mentions, emojis and code as they are. Nothing is
+        translated if the message has nothing to translate.
+
+        :param text: The message to translate
+        :param targets: The languages to translate to
+        :param source: The language to translate from
+
+        :return: The translation
+        """
+        masked = MaskedText(text)
+        if not masked.is_translatable():
+            return
+
+        for target in targets:
+            translation = await self.translate(masked.text, target, source)
+            yield Translation(source, target, text, masked.unmask(translation.text))
+
     async def translate_texts(
         self,
         texts: Iterable[str],
@@ -485,6 +717,14 @@ def get_translator() -> BaseTranslator:
     return GoogleTranslator()
 
 
+@cache
+def get_language_detector() -> LanguageDetector:
+    """Get the shared language detector, loading its model on the first call.
+    It only detects the languages supported by the translator.
+    """
+    return LanguageDetector(get_translator().get_supported_languages())
+
+
 class Cache:
     """Provides caching functionality."""
 
@@ -0,0 +1 @@
+"""Contains the tests."""
@@ -0,0 +1,79 @@
+"""Tests the chat sessions against a MongoDB server, such as the one of
+docker-compose-dev.yml. The tests are skipped if no server is available.
+"""
+
+import os
+
+import pymongo
+import pytest
+from pymongo.errors import PyMongoError
+
+from mongo.chat import ChatSession, Message, collection, get_chat
+
+USER_ID = -1
+
+
+def _is_server_available() -> bool:
+    try:
+        with pymongo.MongoClient(
+            host="mongo" if os.getenv("DOCKER") else None,
+            serverSelectionTimeoutMS=1000,
+        ) as client:
+            client.admin.command("ping")
+    except PyMongoError:
+        return False
+
+    return True
+
+
+pytestmark = pytest.mark.skipif(
+    not _is_server_available(), reason="MongoDB server is not available"
+)
+
+
+def _create_messages(*message_ids: int) -> list[Message]:
+    return [
+        Message(message_id=message_id, channel_id=0, role="user", text="")
+        for message_id in message_ids
+    ]
+
+
+async def _get_message_ids() -> list[int]:
+    chat = await get_chat(USER_ID, ["history"])
+    return [message.message_id for message in chat.history]
+
+
+async def _truncate_after_trim(index: int, regenerated: list[Message]) -> list[int]:
+    """Truncate the history in a session that loaded it before another session
+    trimmed it and appended to it.
+    """
+    await collection.delete_one({"user_id": USER_ID})
+    async with ChatSession(USER_ID) as session:
+        session.extend_history(_create_messages(*range(10)))
+
+    truncating = await ChatSession(USER_ID).__aenter__()
+
+    async with ChatSession(USER_ID) as session:
+        session.trim_history(6)
+        session.extend_history(_create_messages(10, 11))
+
+    truncating.truncate_history(index)
+    truncating.extend_history(regenerated)
+    await truncating.flush()
+
+    try:
+        return await _get_message_ids()
+    finally:
+        await collection.delete_one({"user_id": USER_ID})
+
+
+@pytest.mark.asyncio
+async def test_truncate_after_concurrent_trim() -> None:
+    """Test that the truncated messages are found by their ids, not by their
+    positions when loaded.
+    """
+    # Deleting the message 4 removes it and the later messages
+    assert await _truncate_after_trim(4, []) == []
+
+    # Editing the message 6 replaces it and the later messages
+    assert await _truncate_after_trim(6, _create_messages(6, 12)) == [4, 5, 6, 12]